@@ -0,0 +1,6 @@
+from asgiref.wsgi import WsgiToAsgi
+from main import app
+
+# ASGI entry point, e.g. `uvicorn asgi:application`; async views such as the OAuth callback
+# still run their blocking calls in worker threads, so one login never stalls the event loop
+application = WsgiToAsgi(app)
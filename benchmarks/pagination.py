@@ -0,0 +1,81 @@
+"""Pages through GET /loads with offset links and with cursor links and times each page.
+
+Runs against the Datastore emulator, e.g.
+
+    gcloud beta emulators datastore start
+    $(gcloud beta emulators datastore env-init)
+    python benchmarks/pagination.py --entities 10000 --limit 5
+
+or, without any network, against the in-memory backend with DATASTORE_BACKEND=memory.
+"""
+from google.cloud import datastore
+from urllib.parse import urlsplit
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from repository import repo
+from main import app
+import constants
+
+
+def seed_loads(count):
+    # Tops the loads kind up to count entities
+    existing = repo.count(constants.loads)
+
+    missing = count - existing
+    keys = repo.allocate_ids(constants.loads, missing) if missing > 0 else []
+    for start in range(0, len(keys), 500):
+        batch = []
+        for load_key in keys[start:start + 500]:
+            load = datastore.entity.Entity(key=load_key)
+            load.update({"volume": 1, "item": "bench", "creation_date": "01/01/2022", "carrier": None})
+            batch.append(load)
+        repo.put_multi(batch)
+
+
+def walk(test_client, first_url):
+    """Follows the next links from first_url and returns the latency of every page in ms"""
+    timings = []
+    url = first_url
+
+    while url:
+        start = time.perf_counter()
+        res = test_client.get(url, headers={'Accept': 'application/json'})
+        timings.append((time.perf_counter() - start) * 1000)
+
+        next_url = res.get_json().get("next")
+        url = None
+        if next_url:
+            parts = urlsplit(next_url)
+            url = parts.path + "?" + parts.query
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--entities', type=int, default=10000)
+    parser.add_argument('--limit', type=int, default=5)
+    args = parser.parse_args()
+
+    seed_loads(args.entities)
+    test_client = app.test_client()
+
+    results = {
+        "offset": walk(test_client, "/loads?limit={}".format(args.limit)),
+        "cursor": walk(test_client, "/loads?limit={}&cursor=".format(args.limit)),
+    }
+
+    print("{:>8} {:>8} {:>12} {:>12} {:>12} {:>12}".format(
+        "mode", "pages", "first (ms)", "middle (ms)", "last (ms)", "total (s)"))
+    for mode, timings in results.items():
+        print("{:>8} {:>8} {:>12.1f} {:>12.1f} {:>12.1f} {:>12.1f}".format(
+            mode, len(timings), timings[0], timings[len(timings) // 2], timings[-1], sum(timings) / 1000))
+
+
+if __name__ == '__main__':
+    main()
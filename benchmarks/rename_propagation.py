@@ -0,0 +1,82 @@
+"""Times boat rename propagation against the number of loads the boat carries.
+
+Runs against the Datastore emulator, e.g.
+
+    gcloud beta emulators datastore start
+    $(gcloud beta emulators datastore env-init)
+    python benchmarks/rename_propagation.py --loads 0 10 100 500 1000
+
+or, without any network, against the in-memory backend with DATASTORE_BACKEND=memory.
+"""
+from google.cloud import datastore
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from repository import repo
+import boats
+import constants
+
+
+def seed_boat(load_count, name):
+    boat_key = repo.allocate_ids(constants.boats, 1)[0]
+    boat = datastore.entity.Entity(key=boat_key)
+    boat.update({"name": name, "type": "bench", "length": 1, "loads": [], "owner": "bench"})
+    repo.run_in_transaction(boats.write_boat, boat)
+
+    load_keys = repo.allocate_ids(constants.loads, load_count) if load_count else []
+    loads = []
+    for load_key in load_keys:
+        load = datastore.entity.Entity(key=load_key)
+        load.update({"volume": 1, "item": "bench", "creation_date": "01/01/2022",
+                     "carrier": {"id": str(boat_key.id), "name": name, "self": ""}})
+        loads.append(load)
+        boat["loads"].append({"id": str(load_key.id), "self": ""})
+
+    for chunk in boats.chunks(loads, boats.COMMIT_BATCH_SIZE):
+        repo.put_multi(chunk)
+    repo.put(boat)
+    return boat
+
+
+def rename_per_load(boat, name):
+    # The previous implementation: one get and one put per carried load
+    for load_item in boat["loads"]:
+        load = repo.get(repo.key(constants.loads, int(load_item["id"])))
+        load["carrier"]["name"] = name
+        repo.put(load)
+    boat["name"] = name
+    repo.put(boat)
+
+
+def rename_batched(boat, name):
+    boats.update_boat(boat.key, {"name": name})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--loads', type=int, nargs='+', default=[0, 10, 100, 500, 1000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print("{:>8} {:>14} {:>14}".format("loads", "per-load (ms)", "batched (ms)"))
+    for load_count in args.loads:
+        timings = {}
+        for label, rename in (("per-load", rename_per_load), ("batched", rename_batched)):
+            best = None
+            for run in range(args.repeat):
+                boat = seed_boat(load_count, "bench {} {} {}".format(label, load_count, run))
+                start = time.perf_counter()
+                rename(boat, "renamed {} {} {}".format(label, load_count, run))
+                elapsed = (time.perf_counter() - start) * 1000
+                best = elapsed if best is None else min(best, elapsed)
+            timings[label] = best
+
+        print("{:>8} {:>14.1f} {:>14.1f}".format(load_count, timings["per-load"], timings["batched"]))
+
+
+if __name__ == '__main__':
+    main()
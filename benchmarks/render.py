@@ -0,0 +1,61 @@
+"""Compares the old response path (mutate entities, stdlib json.dumps) with render.py.
+
+Builds pages of 5, 100 and 1000 load entities in memory and times serializing each page:
+
+    python benchmarks/render.py --sizes 5 100 1000 --repeat 200
+"""
+from google.cloud import datastore
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import render
+
+BASE_URL = "http://localhost/loads"
+
+
+def make_page(size):
+    page = []
+    for load_id in range(1, size + 1):
+        load = datastore.Entity(key=datastore.Key("loads", load_id, project="bench"))
+        load.update({"volume": load_id, "item": "item {}".format(load_id), "creation_date": "01/01/2022",
+                     "carrier": {"id": "7", "name": "boat 7", "self": "http://localhost/boats/7"}})
+        page.append(load)
+    return page
+
+
+def old_path(page):
+    # What the handlers did before: write id/self into each entity, then stdlib json
+    for load in page:
+        load["id"] = load.key.id
+        load["self"] = BASE_URL + "/" + str(load.key.id)
+    return json.dumps({"loads": page, "total_loads": len(page)})
+
+
+def new_path(page):
+    return render.dumps({"loads": render.entities(page, BASE_URL), "total_loads": len(page)})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[5, 100, 1000])
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    encoder = "orjson" if render.orjson is not None else "json (orjson not installed)"
+    print("render.py encoder: " + encoder)
+    print("{:>8} {:>14} {:>14} {:>10}".format("entities", "old (us/page)", "new (us/page)", "speedup"))
+
+    for size in args.sizes:
+        page = make_page(size)
+        old = min(timeit.repeat(lambda: old_path(page), number=args.repeat, repeat=3)) / args.repeat * 1e6
+        new = min(timeit.repeat(lambda: new_path(page), number=args.repeat, repeat=3)) / args.repeat * 1e6
+        print("{:>8} {:>14.1f} {:>14.1f} {:>9.1f}x".format(size, old, new, old / new))
+
+
+if __name__ == '__main__':
+    main()
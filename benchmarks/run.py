@@ -0,0 +1,286 @@
+"""Drives a reproducible mix of requests through every blueprint and reports latency per route.
+
+Boots main.app on the in-memory datastore backend with the Google token verifier, token
+exchange and People API stubbed out, seeds the fixture, replays a seeded request mix and
+writes throughput and p50/p95/p99 per route to JSON for comparison between commits:
+
+    python benchmarks/run.py --fixture 1k --requests 5000
+    python benchmarks/run.py --fixture 100k --requests 20000 --output results-100k.json
+
+Needs the deployment's constants.py (kind names, client id) on the path like the app itself.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The stand-in datastore must be chosen before the repository is imported
+os.environ.setdefault('DATASTORE_BACKEND', 'memory')
+
+from datetime import datetime, timezone
+from google.cloud import datastore
+from repository import repo
+from state_generator import state_gen
+import boats
+import constants
+import counters
+import transport
+
+# Boats, loads, slips and users seeded by each preset; loads are spread over the boats
+FIXTURES = {
+    "10": {"boats": 10, "loads": 10, "slips": 10, "users": 10},
+    "1k": {"boats": 1000, "loads": 1000, "slips": 100, "users": 100},
+    "100k": {"boats": 100000, "loads": 100000, "slips": 1000, "users": 1000},
+}
+
+# Relative weight of each request in the mix
+MIX = (
+    ("GET /boats", 15),
+    ("GET /boats/<bid>", 12),
+    ("POST /boats", 3),
+    ("PATCH /boats/<bid>", 4),
+    ("GET /boats/<bid>/loads", 6),
+    ("PUT+DELETE /boats/<bid>/loads/<lid>", 4),
+    ("GET /loads", 15),
+    ("GET /loads/<lid>", 15),
+    ("POST /loads", 5),
+    ("PATCH /loads/<lid>", 4),
+    ("GET /slips", 3),
+    ("GET /slips/<slip_id>", 5),
+    ("GET /users", 6),
+    ("GET /oauth", 3),
+)
+
+OWNER_COUNT = 10
+TOKEN_PREFIX = "bench-token-"
+
+
+class StubResponse:
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def stub_google():
+    # Tokens are "bench-token-<sub>"; nothing leaves the process
+    def verify_oauth2_token(token, audience):
+        if not token.startswith(TOKEN_PREFIX):
+            raise ValueError("Unknown bench token")
+        return {"sub": token[len(TOKEN_PREFIX):], "exp": time.time() + 3600}
+
+    def post(url, **kwargs):
+        return StubResponse({"access_token": "bench", "id_token": TOKEN_PREFIX + "owner0"})
+
+    def get(url, **kwargs):
+        return StubResponse({"names": [{"givenName": "Bench", "familyName": "Owner"}]})
+
+    transport.verify_oauth2_token = verify_oauth2_token
+    transport.post = post
+    transport.get = get
+
+
+def put_all(entities):
+    for chunk in boats.chunks(entities, boats.COMMIT_BATCH_SIZE):
+        repo.put_multi(chunk)
+
+
+def seed(sizes, rng):
+    """Writes the fixture straight through the repository; returns the ids the mix picks from"""
+    boat_keys = repo.allocate_ids(constants.boats, sizes["boats"])
+    load_keys = repo.allocate_ids(constants.loads, sizes["loads"])
+    slip_keys = repo.allocate_ids(constants.slips, sizes["slips"])
+
+    boat_entities, names, loads, slips, users = [], [], [], [], []
+
+    for index, boat_key in enumerate(boat_keys):
+        boat = datastore.entity.Entity(key=boat_key)
+        boat.update({"name": "boat {}".format(index), "type": "bench", "length": rng.randint(10, 99),
+                     "loads": [], "owner": "owner{}".format(index % OWNER_COUNT)})
+        boat_entities.append(boat)
+
+        name = datastore.entity.Entity(key=repo.key(boats.BOAT_NAMES_KIND, boat["name"]))
+        name.update({"boat_id": boat_key.id})
+        names.append(name)
+
+    # Every other load starts on a boat
+    for index, load_key in enumerate(load_keys):
+        load = datastore.entity.Entity(key=load_key)
+        load.update({"volume": rng.randint(1, 500), "item": "crate {}".format(index),
+                     "creation_date": "01/01/2022", "carrier": None})
+        if index % 2 and boat_entities:
+            boat = boat_entities[index % len(boat_entities)]
+            load["carrier"] = {"id": str(boat.key.id), "name": boat["name"], "self": ""}
+            boat["loads"].append({"id": str(load_key.id), "self": ""})
+        loads.append(load)
+
+    for index, slip_key in enumerate(slip_keys):
+        slip = datastore.entity.Entity(key=slip_key)
+        slip.update({"number": index + 1, "current_boat": None})
+        slips.append(slip)
+
+    for index in range(sizes["users"]):
+        user = datastore.entity.Entity(key=repo.key(constants.users, "user{}".format(index)))
+        user.update({"first": "First{}".format(index), "last": "Last", "sub": "user{}".format(index)})
+        users.append(user)
+
+    for entities in (boat_entities, names, loads, slips, users):
+        put_all(entities)
+    counters.repair()
+
+    return {
+        "boats": [(str(boat.key.id), boat["owner"]) for boat in boat_entities],
+        "loads": [str(key.id) for key in load_keys],
+        "free_loads": [str(load.key.id) for load in loads if load["carrier"] is None],
+        "slips": [str(key.id) for key in slip_keys],
+    }
+
+
+def auth(owner):
+    return {"Authorization": "Bearer " + TOKEN_PREFIX + owner, "Accept": "application/json"}
+
+
+def new_state():
+    # A fresh login state for each callback, as the login page would have stored
+    state = state_gen()
+    entity = datastore.entity.Entity(key=repo.key(constants.states, state))
+    entity.update({"state": state, "created": datetime.now(timezone.utc)})
+    repo.put(entity)
+    return state
+
+
+def send(client, route, ids, rng, counter):
+    """Issues one request of the given route with randomly picked fixture ids; returns its status"""
+    accept = {"Accept": "application/json"}
+    bid, owner = rng.choice(ids["boats"])
+    lid = rng.choice(ids["loads"])
+
+    if route == "GET /boats":
+        return client.get("/boats?limit=5", headers=auth(owner)).status_code
+    elif route == "GET /boats/<bid>":
+        return client.get("/boats/" + bid, headers=auth(owner)).status_code
+    elif route == "POST /boats":
+        body = {"name": "new boat {}".format(next(counter)), "type": "bench", "length": 5}
+        return client.post("/boats", json=body, headers=auth(owner)).status_code
+    elif route == "PATCH /boats/<bid>":
+        return client.patch("/boats/" + bid, json={"length": rng.randint(10, 99)}, headers=auth(owner)).status_code
+    elif route == "GET /boats/<bid>/loads":
+        return client.get("/boats/" + bid + "/loads", headers=auth(owner)).status_code
+    elif route == "PUT+DELETE /boats/<bid>/loads/<lid>":
+        free = rng.choice(ids["free_loads"])
+        status = client.put("/boats/" + bid + "/loads/" + free, headers=auth(owner)).status_code
+        client.delete("/boats/" + bid + "/loads/" + free, headers=auth(owner))
+        return status
+    elif route == "GET /loads":
+        return client.get("/loads?limit=5&offset=" + str(rng.randint(0, 50)), headers=accept).status_code
+    elif route == "GET /loads/<lid>":
+        return client.get("/loads/" + lid, headers=accept).status_code
+    elif route == "POST /loads":
+        body = {"item": "bench crate", "volume": rng.randint(1, 500), "creation_date": "02/03/2022"}
+        return client.post("/loads", json=body, headers=accept).status_code
+    elif route == "PATCH /loads/<lid>":
+        return client.patch("/loads/" + lid, json={"volume": rng.randint(1, 500)}, headers=accept).status_code
+    elif route == "GET /slips":
+        return client.get("/slips", headers=accept).status_code
+    elif route == "GET /slips/<slip_id>":
+        return client.get("/slips/" + rng.choice(ids["slips"]), headers=accept).status_code
+    elif route == "GET /users":
+        return client.get("/users?limit=5", headers=accept).status_code
+    elif route == "GET /oauth":
+        return client.get("/oauth?code=bench&state=" + new_state()).status_code
+    raise ValueError(route)
+
+
+def percentile(ordered, fraction):
+    # Nearest-rank percentile of an already sorted list
+    return ordered[min(len(ordered) - 1, max(0, int(round(fraction * len(ordered))) - 1))]
+
+
+def summarize(samples, elapsed):
+    routes = {}
+    for route, timings in sorted(samples.items()):
+        durations = sorted(duration for duration, status in timings)
+        routes[route] = {
+            "requests": len(timings),
+            "errors": sum(1 for duration, status in timings if status >= 500),
+            "throughput_rps": len(timings) / sum(durations) if sum(durations) else None,
+            "p50_ms": percentile(durations, 0.50) * 1000,
+            "p95_ms": percentile(durations, 0.95) * 1000,
+            "p99_ms": percentile(durations, 0.99) * 1000,
+        }
+
+    total = sum(len(timings) for timings in samples.values())
+    return {"requests": total, "seconds": elapsed, "throughput_rps": total / elapsed, "routes": routes}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--fixture', choices=sorted(FIXTURES), default="1k")
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--warmup', type=int, default=200, help="requests sent before timing starts")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help="JSON results file (default: benchmarks/results/<commit>-<fixture>.json)")
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    stub_google()
+
+    from main import app
+
+    start = time.perf_counter()
+    ids = seed(FIXTURES[args.fixture], rng)
+    print("seeded {} fixture in {:.1f}s".format(args.fixture, time.perf_counter() - start))
+
+    routes = [route for route, weight in MIX]
+    weights = [weight for route, weight in MIX]
+    plan = rng.choices(routes, weights=weights, k=args.warmup + args.requests)
+    counter = iter(range(10 ** 9))
+    client = app.test_client()
+
+    for route in plan[:args.warmup]:
+        send(client, route, ids, rng, counter)
+
+    samples = {route: [] for route in routes}
+    start = time.perf_counter()
+    for route in plan[args.warmup:]:
+        request_start = time.perf_counter()
+        status = send(client, route, ids, rng, counter)
+        samples[route].append((time.perf_counter() - request_start, status))
+    elapsed = time.perf_counter() - start
+
+    results = summarize({route: timings for route, timings in samples.items() if timings}, elapsed)
+    results.update({"commit": git_commit(), "fixture": args.fixture, "sizes": FIXTURES[args.fixture],
+                    "seed": args.seed, "python": platform.python_version()})
+
+    print("{:<38} {:>7} {:>6} {:>9} {:>9} {:>9}".format("route", "count", "5xx", "p50 ms", "p95 ms", "p99 ms"))
+    for route, stats in results["routes"].items():
+        print("{:<38} {:>7} {:>6} {:>9.2f} {:>9.2f} {:>9.2f}".format(
+            route, stats["requests"], stats["errors"], stats["p50_ms"], stats["p95_ms"], stats["p99_ms"]))
+    print("{} requests in {:.1f}s, {:.0f} req/s".format(results["requests"], elapsed, results["throughput_rps"]))
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), "results",
+                                         "{}-{}.json".format(results["commit"], args.fixture))
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as results_file:
+        json.dump(results, results_file, indent=2)
+    print("results written to " + output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""Measures cold-start cost of main.app: import time and first-request latency.
+
+Every run happens in a fresh interpreter so nothing is warm. Point it at the Datastore
+emulator or at Cloud Datastore to include client and channel setup, e.g.
+
+    $(gcloud beta emulators datastore env-init)
+    python benchmarks/startup.py --runs 10 --path /loads
+
+or use DATASTORE_BACKEND=memory to measure the app alone.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+
+# Runs inside the fresh interpreter and prints its timings as JSON
+PROBE = """
+import json, sys, time
+start = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+test_client = app.test_client()
+for path in sys.argv[1:]:
+    test_client.get(path, headers={'Accept': 'application/json'})
+first_request = time.perf_counter()
+print(json.dumps({"import_ms": (imported - start) * 1000, "first_request_ms": (first_request - imported) * 1000}))
+"""
+
+
+def run_once(paths):
+    output = subprocess.run([sys.executable, '-c', PROBE] + paths, cwd=ROOT, check=True,
+                            capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--path', action='append', dest='paths',
+                        help="request to time after import (repeatable); defaults to /_ah/warmup then /loads")
+    args = parser.parse_args()
+    paths = args.paths or ['/_ah/warmup', '/loads']
+
+    runs = [run_once(paths) for _ in range(args.runs)]
+
+    print("{:>18} {:>10} {:>10} {:>10}".format("", "median", "min", "max"))
+    for metric in ("import_ms", "first_request_ms"):
+        values = [run[metric] for run in runs]
+        print("{:>18} {:>10.1f} {:>10.1f} {:>10.1f}".format(
+            metric, statistics.median(values), min(values), max(values)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,225 @@
+"""Hammers load/unload, boat and load edits and load deletion from many threads, then checks the boat/load invariants.
+
+Runs on the in-memory backend with a stubbed token verifier, so it needs no network:
+
+    python benchmarks/stress.py --threads 16 --operations 300 --boats 4 --loads 40
+
+Exits non-zero if any invariant is broken:
+  * a load on a boat is listed in that boat's loads exactly once, and only there
+  * every entry of a boat's loads is a load whose carrier is that boat
+  * racing PUTs of one load onto different boats let exactly one of them succeed
+  * loads put on a boat while it is being edited stay listed on it
+  * the loads counter matches the number of loads
+"""
+import argparse
+import collections
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+os.environ.setdefault('DATASTORE_BACKEND', 'memory')
+
+from google.cloud import datastore
+from repository import repo
+import constants
+import counters
+import metrics
+import transport
+
+OWNER = "stress"
+HEADERS = {"Authorization": "Bearer stress", "Accept": "application/json"}
+
+
+def seed(boat_count, load_count):
+    boat_ids, load_ids = [], []
+
+    for index, boat_key in enumerate(repo.allocate_ids(constants.boats, boat_count)):
+        boat = datastore.entity.Entity(key=boat_key)
+        boat.update({"name": "stress {}".format(index), "type": "stress", "length": 1, "loads": [], "owner": OWNER})
+        repo.put(boat)
+        boat_ids.append(str(boat_key.id))
+
+    for load_key in repo.allocate_ids(constants.loads, load_count):
+        load = datastore.entity.Entity(key=load_key)
+        load.update({"volume": 1, "item": "stress", "creation_date": "01/01/2022", "carrier": None})
+        repo.put(load)
+        load_ids.append(str(load_key.id))
+
+    counters.increment(counters.LOADS, load_count)
+    return boat_ids, load_ids
+
+
+def worker(app, boat_ids, load_ids, operations, seed, statuses):
+    rng = random.Random(seed)
+    client = app.test_client()
+
+    for _ in range(operations):
+        bid = rng.choice(boat_ids)
+        roll = rng.random()
+
+        if roll < 0.47:
+            res = client.put("/boats/{}/loads/{}".format(bid, rng.choice(load_ids)), headers=HEADERS)
+            statuses["PUT one"][res.status_code] += 1
+        elif roll < 0.90:
+            res = client.delete("/boats/{}/loads/{}".format(bid, rng.choice(load_ids)), headers=HEADERS)
+            statuses["DELETE one"][res.status_code] += 1
+        elif roll < 0.94:
+            # Renames carry the boat's new name onto its loads, so they race with load/unload too
+            body = {"name": "stress {} {}".format(seed, rng.randrange(10 ** 9))} if roll < 0.92 else {"length": 2}
+            res = client.patch("/boats/{}".format(bid), json=body, headers=HEADERS)
+            statuses["PATCH boat"][res.status_code] += 1
+        elif roll < 0.97:
+            res = client.put("/boats/{}/loads".format(bid), json=rng.sample(load_ids, 3), headers=HEADERS)
+            statuses["PUT many"][res.status_code] += 1
+        elif roll < 0.99:
+            # Load edits must keep whatever carrier a concurrent load/unload gave the load
+            res = client.patch("/loads/{}".format(rng.choice(load_ids)), json={"volume": 2}, headers=HEADERS)
+            statuses["PATCH load"][res.status_code] += 1
+        else:
+            res = client.delete("/loads/{}".format(rng.choice(load_ids)), headers=HEADERS)
+            statuses["DELETE load"][res.status_code] += 1
+
+
+def race_one_load(app, boat_ids, threads):
+    """Every thread puts the same free load on a different boat at once; returns the success count"""
+    load_key = repo.allocate_ids(constants.loads, 1)[0]
+    load = datastore.entity.Entity(key=load_key)
+    load.update({"volume": 1, "item": "race", "creation_date": "01/01/2022", "carrier": None})
+    repo.put(load)
+    counters.increment(counters.LOADS)
+
+    barrier = threading.Barrier(threads)
+    results = []
+
+    def racer(bid):
+        client = app.test_client()
+        barrier.wait()
+        results.append(client.put("/boats/{}/loads/{}".format(bid, load_key.id), headers=HEADERS).status_code)
+
+    racers = [threading.Thread(target=racer, args=(boat_ids[index % len(boat_ids)],)) for index in range(threads)]
+    for thread in racers:
+        thread.start()
+    for thread in racers:
+        thread.join()
+
+    return results.count(204)
+
+
+def race_boat_patch(app, boat_ids, threads):
+    """Half the threads edit one boat while the others put fresh loads on it; returns loads it lost"""
+    bid = boat_ids[0]
+    load_keys = repo.allocate_ids(constants.loads, threads)
+    for load_key in load_keys:
+        load = datastore.entity.Entity(key=load_key)
+        load.update({"volume": 1, "item": "race", "creation_date": "01/01/2022", "carrier": None})
+        repo.put(load)
+        counters.increment(counters.LOADS)
+
+    barrier = threading.Barrier(threads)
+    loaded = []
+
+    def patcher(index):
+        client = app.test_client()
+        barrier.wait()
+        client.patch("/boats/{}".format(bid), json={"length": index + 1}, headers=HEADERS)
+
+    def loader(load_key):
+        client = app.test_client()
+        barrier.wait()
+        if client.put("/boats/{}/loads/{}".format(bid, load_key.id), headers=HEADERS).status_code == 204:
+            loaded.append(str(load_key.id))
+
+    racers = [threading.Thread(target=patcher, args=(index,)) if index % 2 else
+              threading.Thread(target=loader, args=(load_keys[index],)) for index in range(threads)]
+    for thread in racers:
+        thread.start()
+    for thread in racers:
+        thread.join()
+
+    listed = {load_item["id"] for load_item in repo.get(repo.key(constants.boats, int(bid)))["loads"]}
+    return [lid for lid in loaded if lid not in listed]
+
+
+def check_invariants():
+    problems = []
+    boats = {str(boat.key.id): boat for boat in repo.scan(constants.boats)}
+    loads = {str(load.key.id): load for load in repo.scan(constants.loads)}
+
+    listed = collections.Counter()
+    for bid, boat in boats.items():
+        for load_item in boat["loads"]:
+            listed[load_item["id"]] += 1
+            load = loads.get(load_item["id"])
+            if load is None:
+                problems.append("boat {} lists deleted load {}".format(bid, load_item["id"]))
+            elif not load["carrier"] or load["carrier"]["id"] != bid:
+                problems.append("boat {} lists load {} carried by {}".format(bid, load_item["id"], load["carrier"]))
+
+    for lid, load in loads.items():
+        if load["carrier"]:
+            if listed[lid] != 1:
+                problems.append("load {} on boat {} is listed {} times".format(lid, load["carrier"]["id"], listed[lid]))
+        elif listed[lid]:
+            problems.append("free load {} is listed on a boat".format(lid))
+
+    if counters.total(counters.LOADS) != len(loads):
+        problems.append("loads counter is {} for {} loads".format(counters.total(counters.LOADS), len(loads)))
+
+    return problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=16)
+    parser.add_argument('--operations', type=int, default=300, help="requests per thread")
+    parser.add_argument('--boats', type=int, default=4)
+    parser.add_argument('--loads', type=int, default=40)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    transport.verify_oauth2_token = lambda token, audience: {"sub": OWNER, "exp": time.time() + 3600}
+
+    from main import app
+
+    boat_ids, load_ids = seed(args.boats, args.loads)
+    statuses = collections.defaultdict(collections.Counter)
+
+    threads = [threading.Thread(target=worker, args=(app, boat_ids, load_ids, args.operations, args.seed + index,
+                                                      statuses))
+               for index in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    winners = race_one_load(app, boat_ids, args.threads)
+    dropped = race_boat_patch(app, boat_ids, args.threads)
+
+    print("{} requests from {} threads in {:.1f}s".format(args.threads * args.operations, args.threads, elapsed))
+    for operation, counts in sorted(statuses.items()):
+        print("  {:<12} {}".format(operation, dict(sorted(counts.items()))))
+    for (labels, retries) in sorted(metrics.registry.retries.items()):
+        print("  retries      {} {}".format(dict(labels)["transaction"], retries))
+    for (labels, count) in sorted(metrics.registry.transactions.items()):
+        print("  transactions {} {} {}".format(dict(labels)["transaction"], dict(labels)["outcome"], count))
+
+    problems = check_invariants()
+    if winners != 1:
+        problems.append("{} of {} racing PUTs of one load succeeded".format(winners, args.threads))
+    for lid in dropped:
+        problems.append("load {} put on a boat during a PATCH is not listed on it".format(lid))
+
+    for problem in problems:
+        print("BROKEN: " + problem)
+    print("invariants hold" if not problems else "{} invariant violations".format(len(problems)))
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == '__main__':
+    main()
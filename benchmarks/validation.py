@@ -0,0 +1,89 @@
+"""Compares validator throughput of the old inline checks with the precompiled schemas in validation.py.
+
+Runs without any backend or network:
+
+    python benchmarks/validation.py --bodies 100000
+"""
+from datetime import datetime
+from string import ascii_letters, digits, whitespace
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import validation
+
+
+def inline_load_valid(content):
+    # The checks POST /loads ran inline before validation.py
+    if not content or "item" not in content or "volume" not in content or "creation_date" not in content:
+        return False
+
+    if set(content["item"]).difference(ascii_letters + digits + whitespace) \
+            or not isinstance(content["volume"], int) or len(content["creation_date"]) != 10:
+        return False
+
+    try:
+        datetime.strptime(content["creation_date"], "%m/%d/%Y")
+    except ValueError:
+        return False
+
+    return True
+
+
+def inline_boat_valid(content):
+    # The checks POST /boats ran inline before validation.py
+    if not content or "name" not in content or "type" not in content or "length" not in content:
+        return False
+
+    if not content["name"] or set(content["name"]).difference(ascii_letters + digits + whitespace) or \
+            set(content["type"]).difference(ascii_letters + digits + whitespace) \
+            or not isinstance(content["length"], int):
+        return False
+
+    return True
+
+
+def make_bodies(count, seed=1):
+    # Mostly valid manifest lines over a year of dates, with some bad characters and dates mixed in
+    rng = random.Random(seed)
+    loads, boats = [], []
+    for i in range(count):
+        month, day = rng.randint(1, 12), rng.randint(1, 28)
+        item = "crate of parts {}".format(i) if i % 10 else "crate #{}".format(i)
+        creation_date = "{:02d}/{:02d}/2021".format(month, day) if i % 17 else "02/30/2021"
+        loads.append({"item": item, "volume": rng.randint(1, 500), "creation_date": creation_date})
+        boats.append({"name": "Sea Queen {}".format(i), "type": "Catamaran", "length": rng.randint(10, 99)})
+    return loads, boats
+
+
+def rate(check, bodies):
+    start = time.perf_counter()
+    for body in bodies:
+        check(body)
+    return len(bodies) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--bodies', type=int, default=100000)
+    args = parser.parse_args()
+
+    loads, boats = make_bodies(args.bodies)
+
+    # Both paths must agree on which bodies are valid
+    assert [inline_load_valid(body) for body in loads] == [not validation.LOAD.validate(body) for body in loads]
+    assert [inline_boat_valid(body) for body in boats] == [not validation.BOAT.validate(body) for body in boats]
+
+    print("{:>6} {:>18} {:>18} {:>8}".format("schema", "inline (bodies/s)", "schema (bodies/s)", "speedup"))
+    for name, inline, schema, bodies in (("load", inline_load_valid, validation.LOAD.validate, loads),
+                                         ("boat", inline_boat_valid, validation.BOAT.validate, boats)):
+        old, new = rate(inline, bodies), rate(schema, bodies)
+        print("{:>6} {:>18.0f} {:>18.0f} {:>7.1f}x".format(name, old, new, new / old))
+
+
+if __name__ == '__main__':
+    main()
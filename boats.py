@@ -1,17 +1,288 @@
-from flask import Blueprint, request, make_response
+from flask import Blueprint, Response, request, make_response
 from google.cloud import datastore
-import json
+from google.api_core.exceptions import Conflict
 import constants
 from json2html import *
-from string import ascii_letters, digits, whitespace
-from google.oauth2 import id_token
-from google.auth.transport import requests
-
-client = datastore.Client()
+from ttl_cache import TTLCache
+from repository import repo
+import transport
+import counters
+import pagination
+import etags
+import render
+import validation
+import metrics
+import hashlib
 
 bp = Blueprint('boat', __name__, url_prefix='/boats')
 
+# Verified JWTs, keyed by a digest of the token and mapped to their sub until the token's exp
+jwt_cache = TTLCache(capacity=1024)
+
+
+def verify_jwt(token):
+    # Repeat callers are served from the cache instead of a full signature check
+    digest = hashlib.sha256(token.encode('utf-8')).hexdigest()
+    sub = jwt_cache.get(digest)
+
+    if sub is None:
+        id_info = transport.verify_oauth2_token(token, constants.client_id)
+        sub = id_info['sub']
+        jwt_cache.set(digest, sub, expires_at=id_info.get('exp'))
+
+    return sub
+
+
+# Kind holding one entity per boat name (key name = boat name), pointing at the boat that owns it
+BOAT_NAMES_KIND = "boat_names"
+
+
+def reserve_boat_name(name, boat_id):
+    """Claims name for boat_id in the current transaction; returns False if another boat holds it"""
+    name_key = repo.key(BOAT_NAMES_KIND, name)
+    reservation = repo.get(name_key)
+
+    if reservation is not None:
+        return reservation["boat_id"] == boat_id
+
+    # Boats created before reservations existed hold their name without one, so the name is also
+    # looked up on the boats; a holder found that way gets its reservation written now
+    holders = repo.query(constants.boats, filters=[("name", "=", name)], keys_only=True, limit=2).entities
+    holder_ids = [holder.key.id for holder in holders if holder.key.id != boat_id]
+
+    reservation = datastore.entity.Entity(key=name_key)
+    reservation.update({"boat_id": holder_ids[0] if holder_ids else boat_id})
+    repo.put(reservation)
+    return not holder_ids
+
+
+def release_boat_name(name, boat_id):
+    # Only removes the reservation if it still belongs to this boat
+    name_key = repo.key(BOAT_NAMES_KIND, name)
+    reservation = repo.get(name_key)
+
+    if reservation is not None and reservation["boat_id"] == boat_id:
+        repo.delete(name_key)
+
+
+# Datastore accepts at most 500 mutations per commit
+COMMIT_BATCH_SIZE = 500
+
+
+def chunks(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def rename_carried_loads(load_keys, name, bid):
+    # One get_multi and one put_multi for the whole batch instead of a get and put per load;
+    # only loads still carried by this boat are renamed
+    loads = repo.get_multi(load_keys)
+    carried = [load for load in loads if load["carrier"] and load["carrier"]["id"] == bid]
+
+    for load in carried:
+        load["carrier"]["name"] = name
+
+    if carried:
+        repo.put_multi(carried)
+
+
+def write_boat(boat, old_name=None, created=False, load_keys=()):
+    """Writes the boat and its name reservation in the current transaction; returns False if the name is taken
+
+    On a rename the carrier name of the given loads is rewritten as well, and a created boat is added
+    to its owner's boat counter.
+    """
+    if not reserve_boat_name(boat["name"], boat.key.id):
+        return False
+
+    if old_name is not None and old_name != boat["name"]:
+        release_boat_name(old_name, boat.key.id)
+
+    repo.put(boat)
+
+    if created:
+        counters.increment(counters.boats_counter(boat["owner"]))
+
+    if load_keys:
+        rename_carried_loads(load_keys, boat["name"], str(boat.key.id))
+
+    return True
+
+
+def update_stored_boat(boat_key, changes, expected_etag=None):
+    """Applies changes to the boat as stored now, re-read inside the transaction
+
+    Returns (boat, keys of loads still to rename), None if the boat is gone, or False if its new
+    name is taken. With expected_etag it fails with PreconditionFailed if the stored boat differs.
+    """
+    boat = repo.get(boat_key)
+    if boat is None:
+        return None
+
+    etags.check_unchanged(boat, expected_etag)
+
+    old_name = boat["name"]
+    boat.update(changes)
+
+    # The carried loads come from the fresh copy, so loads put on the boat concurrently are renamed too
+    load_keys = []
+    if old_name != boat["name"]:
+        load_keys = [repo.key(constants.loads, int(load_item["id"])) for load_item in boat["loads"]]
+
+    # The boat, both name reservations and as many loads as fit in one commit are written together
+    if not write_boat(boat, old_name, load_keys=load_keys[:COMMIT_BATCH_SIZE - 4]):
+        return False
+
+    return boat, load_keys[COMMIT_BATCH_SIZE - 4:]
+
+
+def update_boat(boat_key, changes, expected_etag=None):
+    """Updates the stored boat in a transaction retried on contention
+
+    Returns the saved boat, None if it no longer exists, or False if its new name is taken.
+    """
+    updated = repo.run_in_transaction(update_stored_boat, boat_key, changes, expected_etag)
+    if not updated:
+        return updated
+
+    boat, remaining_keys = updated
+
+    # Cargo beyond the mutation limit of a single commit is renamed in follow-up transactions
+    for chunk in chunks(remaining_keys, COMMIT_BATCH_SIZE):
+        repo.run_in_transaction(rename_carried_loads, chunk, boat["name"], str(boat.key.id))
+
+    return boat
+
+
+def clear_carriers(load_keys, bid):
+    # Unloads every load in the batch that is still carried by this boat
+    loads = repo.get_multi(load_keys)
+    carried = [load for load in loads if load["carrier"] and load["carrier"]["id"] == bid]
+
+    for load in carried:
+        load["carrier"] = None
+
+    if carried:
+        repo.put_multi(carried)
+
+
+def delete_stored_boat(boat_key):
+    """One step of deleting the boat as stored now, re-read inside the transaction
+
+    Returns None if the boat is gone, False after clearing loads that do not fit in the final commit,
+    and True once the boat is deleted.
+    """
+    boat = repo.get(boat_key)
+    if boat is None:
+        return None
+
+    bid = str(boat_key.id)
+    load_keys = [repo.key(constants.loads, int(load_item["id"])) for load_item in boat["loads"]]
+
+    # Loads that do not fit in the final commit beside the boat, its name and its counter are
+    # unloaded first, and taken off the boat's list in the same commit
+    if len(load_keys) > COMMIT_BATCH_SIZE - 3:
+        overflow = load_keys[COMMIT_BATCH_SIZE - 3:][:COMMIT_BATCH_SIZE - 1]
+        clear_carriers(overflow, bid)
+
+        cleared = {str(key.id) for key in overflow}
+        boat["loads"] = [load_item for load_item in boat["loads"] if load_item["id"] not in cleared]
+        repo.put(boat)
+        return False
+
+    if load_keys:
+        clear_carriers(load_keys, bid)
+
+    release_boat_name(boat["name"], boat.key.id)
+    counters.increment(counters.boats_counter(boat["owner"]), -1)
+    repo.delete(boat.key)
+    return True
+
+
+def delete_boat(boat_key):
+    """Deletes the boat, frees its name and clears the carrier of every load it holds
+
+    Returns False if the boat no longer exists. Each step is a transaction retried on contention.
+    """
+    while True:
+        deleted = repo.run_in_transaction(delete_stored_boat, boat_key)
+        if deleted is not False:
+            return deleted is not None
+
+
+# Most loads moved by one bulk request; the boat is the commit's 500th mutation
+MAX_CARGO_LOADS = COMMIT_BATCH_SIZE - 1
+
+
+class CargoError(Exception):
+    """Raised inside a load/unload transaction to abort it with an error response"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+def fetch_cargo(bid, lids, missing_message="The specified boat and/or load does not exist"):
+    # The boat and every load are read in the transaction, so a concurrent writer aborts it
+    boat = repo.get(repo.key(constants.boats, int(bid)))
+    loads = repo.get_multi([repo.key(constants.loads, int(lid)) for lid in lids])
+
+    if not boat or len(loads) != len(lids):
+        raise CargoError(404, missing_message)
 
+    # get_multi does not keep the order of the keys
+    loads_by_id = {str(load.key.id): load for load in loads}
+    return boat, [loads_by_id[lid] for lid in lids]
+
+
+def put_cargo(bid, lids, sub, root_url):
+    boat, loads = fetch_cargo(bid, lids)
+
+    if any(load["carrier"] for load in loads):
+        raise CargoError(403, "The load is already loaded on another boat")
+
+    elif boat["owner"] != sub:
+        raise CargoError(401, "The boat is owned by another user")
+
+    for lid, load in zip(lids, loads):
+        boat['loads'].append({"id": lid, "self": root_url + "loads/" + lid})
+        load['carrier'] = {"id": bid, "name": boat['name'], "self": root_url + "boats/" + bid}
+
+    repo.put_multi([boat] + loads)
+
+
+def remove_cargo(bid, lids, sub):
+    not_loaded = "No boat with this boat_id is loaded with the load with this load_id"
+    boat, loads = fetch_cargo(bid, lids, not_loaded)
+
+    carried = {load_item["id"] for load_item in boat["loads"]}
+    if any(lid not in carried or not load["carrier"] or load["carrier"]["id"] != bid
+           for lid, load in zip(lids, loads)):
+        raise CargoError(404, not_loaded)
+
+    elif boat["owner"] != sub:
+        raise CargoError(401, "The boat is owned by another user")
+
+    unloaded = set(lids)
+    boat["loads"] = [load_item for load_item in boat["loads"] if load_item["id"] not in unloaded]
+    for load in loads:
+        load["carrier"] = None
+
+    repo.put_multi([boat] + loads)
+
+
+def load_boat(bid, lids, sub, root_url):
+    """Puts every load on the boat in one transaction, or none of them; retried on contention"""
+    repo.run_in_transaction(put_cargo, bid, lids, sub, root_url)
+
+
+def unload_boat(bid, lids, sub):
+    """Takes every load off the boat in one transaction, or none of them; retried on contention"""
+    repo.run_in_transaction(remove_cargo, bid, lids, sub)
+
+
+@metrics.timed("check_jwt")
 def check_jwt(headers):
     # Checks if JWT was provided in Authorization header
     if 'Authorization' in headers:
@@ -20,8 +291,7 @@ def check_jwt(headers):
 
         # Checks validity of JWT provided
         try:
-            sub = id_token.verify_oauth2_token(
-                auth_header, requests.Request(), constants.client_id)['sub']
+            sub = verify_jwt(auth_header)
             return sub
         except:
             err = {"Error": "JWT is invalid"}
@@ -74,53 +344,42 @@ def boats_get_post():
             res.status_code = 415
             return res
 
-        # Check contents of the json file to make sure keys have values, and it is not empty.
+        # Check contents of the json file to make sure every attribute is present and valid.
         # Only supported attributes will be used. Any additional ones will be ignored.
-        if not content or "name" not in content or "type" not in content or "length" not in content:
-            err = {"Error": "The request object is missing at least one of the required attributes"}
-            res = make_response(err)
+        errors = validation.BOAT.validate(content)
+        if errors:
+            res = make_response(validation.error_body(errors))
             res.headers.set('Content-Type', 'application/json')
             res.status_code = 400
             return res
 
-        # Check value of contents to make sure they are not null or have valid characters.
-        if set(content["name"]).difference(ascii_letters + digits + whitespace) or \
-                set(content["type"]).difference(ascii_letters + digits + whitespace) \
-                or not isinstance(content["length"], int):
-            err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 400
-            return res
-
-        # Name of boat must be unique
-        query = client.query(kind=constants.boats)
-        boat_list = list(query.fetch())
-
-        # Search all boat objects and compare the names to make sure they are unique
-        for curr_boat in boat_list:
-            if curr_boat["name"] == content["name"]:
-                err = {"Error": "There is already a boat with that name"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 403
-                return res
-
         # For future bug closure: Query list of users. If sub not in list of users, return a 401
 
-        # Create new boat entity
-        new_boat = datastore.entity.Entity(key=client.key(constants.boats))
+        # Create new boat entity; the id is allocated up front so the name reservation can point at it
+        boat_key = repo.allocate_ids(constants.boats, 1)[0]
+        new_boat = datastore.entity.Entity(key=boat_key)
         new_boat.update({"name": content["name"], "type": content["type"], "length": content["length"],
                          "loads": [], "owner": sub})
 
-        client.put(new_boat)
-        new_boat["id"] = new_boat.key.id
-        new_boat["self"] = request.base_url + "/" + str(new_boat.key.id)
+        # Name of boat must be unique; a concurrent create of the same name aborts and its retry finds
+        # the name reserved. Contention that outlasts the retries is not a taken name.
+        try:
+            name_free = repo.run_in_transaction(write_boat, new_boat, None, True)
+        except Conflict:
+            err = {"Error": "The boat could not be created because of concurrent requests"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
+            return res
 
-        res = make_response(json.dumps(new_boat))
-        res.mimetype = 'application/json'
-        res.status_code = 201
-        return res
+        if not name_free:
+            err = {"Error": "There is already a boat with that name"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 403
+            return res
+
+        return render.json_response(render.entity(new_boat, request.base_url + "/" + str(new_boat.key.id)), 201)
 
     elif request.method == 'GET':
 
@@ -132,44 +391,29 @@ def boats_get_post():
             res.status_code = 406
             return res
 
-        # Get query of boats by owner and set the limit and offset for the query
-        query = client.query(kind=constants.boats)
-        query.add_filter("owner", "=", sub)
-        total_boats = list(query.fetch(query.keys_only()))
-
-        # Reset the query to show the objects
-        query = client.query(kind=constants.boats)
-        query.add_filter("owner", "=", sub)
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
+        # The owner's boat count comes from its sharded counter instead of enumerating keys
+        total_boats = counters.total(counters.boats_counter(sub))
 
-        # Get result of query and make into a list
-        boat_iterator = query.fetch(limit=q_limit, offset=q_offset)
-        pages = boat_iterator.pages
-        results = list(next(pages))
-
-        # Create a "next" url page using
-        if boat_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-        else:
-            next_url = None
+        # Get one page of the owner's boats, by cursor or by limit and offset, and its "next" url
+        try:
+            results, next_url = pagination.fetch_page(constants.boats, [("owner", "=", sub)],
+                                                      request.args, request.base_url)
+        except pagination.InvalidCursor:
+            res = make_response(pagination.INVALID_CURSOR)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 400
+            return res
 
-        # Adds id key and value to each json slip; add next url
-        for boat in results:
-            boat["id"] = boat.key.id
-            boat["self"] = request.base_url + "/" + str(boat.key.id)
-        output = {"boats": results}
+        # Adds id key and value to each json boat; add next url
+        output = {"boats": render.entities(results, request.base_url)}
 
         if next_url:
             output["next"] = next_url
 
-        output["total_boats"] = len(total_boats)
+        output["total_boats"] = total_boats
 
-        res = make_response(json.dumps(output))
-        res.headers.set('Content-Type', 'application/json')
-        res.status_code = 200
-        return res
+        # Sends json response, or 304 if the client already has this page
+        return etags.conditional(render.json_response(output))
 
     else:
         # Status code 405
@@ -219,8 +463,8 @@ def boats_get_put_delete(bid):
             res.status_code = 415
             return res
 
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
+        boat_key = repo.key(constants.boats, int(bid))
+        boat = repo.get(boat_key)
 
         # Checks if boat with boat_id exists
         if not boat:
@@ -237,68 +481,57 @@ def boats_get_put_delete(bid):
             res.status_code = 401
             return res
 
-        # If any or all of the 3 attributes are provided, they are updated.
-        if "name" in content and content["name"]:
-            # Check value of contents to make sure they are not null or have valid characters.
-            if set(content["name"]).difference(ascii_letters + digits + whitespace):
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
-
-            # Name of boat must be unique
-            query = client.query(kind=constants.boats)
-            boat_list = list(query.fetch())
-
-            # Search all boat objects and compare the names to make sure they are unique
-            for curr_boat in boat_list:
-                if curr_boat["name"] == content["name"]:
-                    err = {"Error": "There is already a boat with that name"}
-                    res = make_response(err)
-                    res.headers.set('Content-Type', 'application/json')
-                    res.status_code = 403
-                    return res
-
-            # Checks if load is on a boat, updates all load names
-            if boat["loads"]:
-                for load_item in boat["loads"]:
-                    load_key = client.key(constants.loads, int(load_item["id"]))
-                    load = client.get(key=load_key)
-                    load["carrier"]["name"] = content["name"]
-                    load.update(load)
-                    client.put(load)
-
-            # Boat name is unique and updated
-            boat.update({"name": content["name"]})
-
-        if "type" in content and content["type"]:
-            # Check value of contents to make sure they are not null or have valid characters.
-            if set(content["type"]).difference(ascii_letters + digits + whitespace):
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
-
-            boat.update({"type": content["type"]})
-
-        if "length" in content and content["length"]:
-            # Check value of contents to make sure they are not null or have valid characters.
-            if not isinstance(content["length"], int):
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
-
-            boat.update({"length": content["length"]})
-
-        client.put(boat)
-
-        res = make_response(json.dumps(boat))
-        res.mimetype = 'application/json'
-        res.status_code = 200
+        # If-Match must name the boat's current ETag, so a client cannot overwrite changes it has not seen
+        elif etags.if_match_failed(boat):
+            err = {"Error": "The boat has been modified since it was last retrieved"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 412
+            return res
+
+        expected_etag = etags.entity_etag(boat) if request.if_match else None
+
+        # If any or all of the 3 attributes are provided, they are all checked and then updated.
+        errors = validation.BOAT.validate(content, partial=True)
+        if errors:
+            res = make_response(validation.error_body(errors))
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 400
+            return res
+
+        # The changes are applied to the boat re-read in the transaction, keeping concurrent load moves.
+        # Name of boat must be unique; the name reservation and carried loads are written with the boat
+        try:
+            boat = update_boat(boat_key, validation.BOAT.updates(content), expected_etag)
+        except etags.PreconditionFailed:
+            err = {"Error": "The boat has been modified since it was last retrieved"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 412
+            return res
+        except Conflict:
+            err = {"Error": "The boat was modified by another request"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
+            return res
+
+        if boat is None:
+            err = {"Error": "No boat with this boat_id exists"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 404
+            return res
+
+        elif not boat:
+            err = {"Error": "There is already a boat with that name"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 403
+            return res
+
+        res = render.json_response(boat)
+        res.set_etag(etags.entity_etag(boat))
         return res
 
     elif request.method == 'PUT':
@@ -331,8 +564,8 @@ def boats_get_put_delete(bid):
             res.status_code = 415
             return res
 
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
+        boat_key = repo.key(constants.boats, int(bid))
+        boat = repo.get(boat_key)
 
         # Checks if boat with boat_id exists
         if not boat:
@@ -349,60 +582,64 @@ def boats_get_put_delete(bid):
             res.status_code = 401
             return res
 
-        # Check contents of the json file to make sure keys have values, and it is not empty.
-        # Only supported attributes will be used. Any additional ones will be ignored.
-        if not content or "name" not in content or "type" not in content or "length" not in content:
-            err = {"Error": "The request object is missing at least one of the required attributes"}
+        # If-Match must name the boat's current ETag, so a client cannot overwrite changes it has not seen
+        elif etags.if_match_failed(boat):
+            err = {"Error": "The boat has been modified since it was last retrieved"}
             res = make_response(err)
             res.headers.set('Content-Type', 'application/json')
+            res.status_code = 412
+            return res
+
+        expected_etag = etags.entity_etag(boat) if request.if_match else None
+
+        # Check contents of the json file to make sure every attribute is present and valid.
+        # Only supported attributes will be used. Any additional ones will be ignored.
+        errors = validation.BOAT.validate(content)
+        if errors:
+            res = make_response(validation.error_body(errors))
+            res.headers.set('Content-Type', 'application/json')
             res.status_code = 400
             return res
 
-        # Check value of contents to make sure they are not null or have valid characters.
-        if set(content["name"]).difference(ascii_letters + digits + whitespace) or \
-                set(content["type"]).difference(ascii_letters + digits + whitespace) \
-                or not isinstance(content["length"], int):
-            err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
+        # Edits all the attributes, except the id, on the boat re-read in the transaction.
+        # Name of boat must be unique; the name reservation and carried loads are written with the boat
+        changes = {"name": content["name"], "type": content["type"], "length": content["length"]}
+        try:
+            boat = update_boat(boat_key, changes, expected_etag)
+        except etags.PreconditionFailed:
+            err = {"Error": "The boat has been modified since it was last retrieved"}
             res = make_response(err)
             res.headers.set('Content-Type', 'application/json')
-            res.status_code = 400
+            res.status_code = 412
+            return res
+        except Conflict:
+            err = {"Error": "The boat was modified by another request"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
             return res
 
-        # Name of boat must be unique
-        query = client.query(kind=constants.boats)
-        boat_list = list(query.fetch())
+        if boat is None:
+            err = {"Error": "No boat with this boat_id exists"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 404
+            return res
 
-        # Search all boat objects and compare the names to make sure they are unique
-        for curr_boat in boat_list:
-            if curr_boat["name"] == content["name"]:
-                err = {"Error": "There is already a boat with that name"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 403
-                return res
+        elif not boat:
+            err = {"Error": "There is already a boat with that name"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 403
+            return res
 
-        # Checks if load is on the boat, updates all load names
-        if boat["loads"]:
-            for load_item in boat["loads"]:
-                load_key = client.key(constants.loads, int(load_item["id"]))
-                load = client.get(key=load_key)
-                print(load)
-                load["carrier"]["name"] = content["name"]
-                load.update(load)
-                client.put(load)
-
-        # Edits all the attributes, except the id
-        boat.update({"name": content["name"], "type": content["type"], "length": content["length"]})
-        client.put(boat)
-
-        res = make_response(json.dumps(boat))
-        res.mimetype = 'application/json'
-        res.status_code = 200
+        res = render.json_response(boat)
+        res.set_etag(etags.entity_etag(boat))
         return res
 
     elif request.method == 'DELETE':
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
+        boat_key = repo.key(constants.boats, int(bid))
+        boat = repo.get(boat_key)
 
         # Checks if boat with boat_id exists
         if not boat:
@@ -419,16 +656,23 @@ def boats_get_put_delete(bid):
             res.status_code = 401
             return res
 
-        # Check to see if load(s) is/are on the boat; remove load(s) (carrier==None)
-        query = client.query(kind=constants.loads)
-        loads_list = list(query.fetch())
-
-        for curr_load in loads_list:
-            if curr_load["carrier"] and curr_load["carrier"]['id'] == bid:
-                curr_load.update({"carrier": None})
-                client.put(curr_load)
+        # Removes the boat's loads (carrier==None) and frees its name along with the boat,
+        # working from the boat as stored when each transaction runs
+        try:
+            deleted = delete_boat(boat_key)
+        except Conflict:
+            err = {"Error": "The boat was modified by another request"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
+            return res
 
-        client.delete(boat_key)
+        if not deleted:
+            err = {"Error": "No boat with this boat_id exists"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 404
+            return res
 
         res = make_response()
         res.status_code = 204
@@ -444,21 +688,18 @@ def boats_get_put_delete(bid):
             res.status_code = 406
             return res
 
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
+        boat_key = repo.key(constants.boats, int(bid))
+        # Hot entities are served from the read-through cache, which writes invalidate
+        boat = repo.get_cached(boat_key)
 
         # Check if boat exists
         if not boat:
             return {"Error": "No boat with this boat_id exists"}, 404
 
-        boat["id"] = boat.key.id
-        boat["self"] = request.base_url
-
-        # Sends json response
-        res = make_response(json.dumps(boat))
-        res.headers.set('Content-Type', 'application/json')
-        res.status_code = 200
-        return res
+        # Sends json response, or 304 if the client already has this version.
+        # The ETag covers the stored boat, not the id and self added for the response.
+        res = render.json_response(render.entity(boat, request.base_url))
+        return etags.conditional(res, etags.entity_etag(boat))
 
     else:
         # Status code 405
@@ -477,100 +718,98 @@ def put_delete_loads_in_boat(bid, lid):
     if not isinstance(sub, str):
         return sub
 
-    if request.method == 'PUT':
-
-        # Gets boat
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
-
-        # Gets load
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
-
-        # Check contents of the json file to make sure slip and boat exists
-        if not load or not boat:
-            err = {"Error": "The specified boat and/or load does not exist"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 404
-            return res
-
-        elif load["carrier"]:
-            err = {"Error": "The load is already loaded on another boat"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 403
-            return res
-
-        elif boat["owner"] != sub:
-            err = {"Error": "The boat is owned by another user"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 401
-            return res
+    if request.method not in ('PUT', 'DELETE'):
+        # Status code 405
+        res = make_response()
+        res.headers.set('Allow', 'PUT, DELETE')
+        res.headers.set('Content-Type', 'text/html')
+        res.status_code = 405
+        return res
 
+    # The boat and the load are read, checked and written in one transaction, retried on contention,
+    # so two requests can never put the same load on two boats or lose each other's boat["loads"] edits
+    try:
+        if request.method == 'PUT':
+            load_boat(bid, [lid], sub, request.root_url)
         else:
-            boat['loads'].append({"id": lid, "self": request.root_url + "loads/" + str(load.key.id)})
-            load['carrier'] = {"id": bid, "name": boat['name'], "self": request.root_url + "boats/" + str(boat.key.id)}
-
-        client.put(boat)
-        client.put(load)
-
-        res = make_response()
-        res.status_code = 204
+            unload_boat(bid, [lid], sub)
+    except CargoError as error:
+        err = {"Error": error.message}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = error.status_code
+        return res
+    except Conflict:
+        err = {"Error": "The boat or the load was modified by another request"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 409
         return res
 
-    elif request.method == 'DELETE':
+    res = make_response()
+    res.status_code = 204
+    return res
 
-        # Gets load
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
 
-        # Gets boat
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
-        boat_check = None
+@bp.route('/<bid>/loads', methods=['PUT', 'DELETE'])
+def put_delete_cargo(bid):
+    # Checks if JWT was provided in Authorization header
+    sub = check_jwt(request.headers)
 
-        if boat:
-            boat_check = next((index for index, load in enumerate(boat['loads'])
-                               if load['id'] == lid), None)
+    if not isinstance(sub, str):
+        return sub
 
-        # Check contents of the json file to make sure slip, boat exists,
-        # and boat is parked at this slip
-        if not load or not boat or load["carrier"] is None or \
-                load["carrier"]['id'] != bid or boat["loads"] == [] or \
-                boat_check is None:
+    if not request.is_json:
+        # Checks if sent data is json, if not return 415
+        err = {"Error": "The request header 'content_type' is not application/json "
+                        "and/or the sent request body does not contain json"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 415
+        return res
 
-            err = {"Error": "No boat with this boat_id is loaded with the load with this load_id"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 404
-            return res
+    content = request.get_json(silent=True)
 
-        elif boat["owner"] != sub:
-            err = {"Error": "The boat is owned by another user"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 401
-            return res
+    # The body is a JSON array of load ids, e.g. ["5", "6"]
+    if not isinstance(content, list) or not content or not bid.isdigit() \
+            or not all(str(lid).isdigit() for lid in content):
+        err = {"Error": "The request body is not a JSON array of load ids"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 400
+        return res
 
-        else:
-            del boat['loads'][boat_check]
-            load["carrier"] = None
-            client.put(boat)
-            client.put(load)
+    # Ids are stored as strings in the boat's loads list; repeats are moved once
+    lids = list(dict.fromkeys(str(lid) for lid in content))
 
-            res = make_response()
-            res.status_code = 204
-            return res
+    if len(lids) > MAX_CARGO_LOADS:
+        err = {"Error": "At most " + str(MAX_CARGO_LOADS) + " loads can be moved in one request"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 413
+        return res
 
-    else:
-        # Status code 405
-        res = make_response()
-        res.headers.set('Allow', 'PUT, DELETE')
-        res.headers.set('Content-Type', 'text/html')
-        res.status_code = 405
+    try:
+        if request.method == 'PUT':
+            load_boat(bid, lids, sub, request.root_url)
+        else:
+            unload_boat(bid, lids, sub)
+    except CargoError as error:
+        err = {"Error": error.message}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = error.status_code
         return res
+    except Conflict:
+        err = {"Error": "The boat or a load was modified by another request"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 409
+        return res
+
+    res = make_response()
+    res.status_code = 204
+    return res
 
 
 @bp.route('/<bid>/loads', methods=['GET'])
@@ -591,8 +830,8 @@ def get_reservations(bid):
         if not isinstance(sub, str):
             return sub
 
-        boat_key = client.key(constants.boats, int(bid))
-        boat = client.get(key=boat_key)
+        boat_key = repo.key(constants.boats, int(bid))
+        boat = repo.get_cached(boat_key)
         load_list = {"self": request.root_url + "boats/" + bid, "loads": []}
 
         # Check if boat exists
@@ -615,19 +854,13 @@ def get_reservations(bid):
             for load in boat['loads']:
                 load_list['loads'].append(load)
 
-            # Sends json response
-            res = make_response(json.dumps(load_list))
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 200
-            return res
+            # Sends json response, or 304 if the client already has this list
+            return etags.conditional(render.json_response(load_list))
 
         # Boat has no loads
         else:
-            # Sends json response
-            res = make_response(json.dumps([]))
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 200
-            return res
+            # Sends json response, or 304 if the client already has this list
+            return etags.conditional(render.json_response([]))
 
     else:
         # Status code 405
@@ -636,3 +869,55 @@ def get_reservations(bid):
         res.headers.set('Content-Type', 'text/html')
         res.status_code = 405
         return res
+
+
+# Boats read per export query page, and most load keys per get_multi (Datastore's limit is 1000)
+EXPORT_PAGE_SIZE = 100
+EXPORT_GET_BATCH_SIZE = 1000
+
+
+def export_lines(sub, root_url):
+    """Yields the owner's boats, each followed by its loads, as NDJSON lines
+
+    The loads of a whole page of boats are fetched together in get_multi batches, so a page costs
+    one query and a few lookups however its loads are spread over the boats. Only one page of
+    boats and their loads are held at a time.
+    """
+    cursor = None
+
+    while True:
+        page = repo.query(constants.boats, filters=[("owner", "=", sub)], limit=EXPORT_PAGE_SIZE, cursor=cursor)
+
+        load_keys = [repo.key(constants.loads, int(load_item["id"]))
+                     for boat in page.entities for load_item in boat["loads"]]
+        loads = {}
+        for chunk in chunks(load_keys, EXPORT_GET_BATCH_SIZE):
+            loads.update((str(load.key.id), load) for load in repo.get_multi(chunk))
+
+        for boat in page.entities:
+            boat_line = render.entity(boat, root_url + "boats/" + str(boat.key.id))
+            boat_line["kind"] = constants.boats
+            yield render.dumps(boat_line) + "\n"
+
+            for load_item in boat["loads"]:
+                load = loads.get(load_item["id"])
+                if load is not None:
+                    load_line = render.entity(load, root_url + "loads/" + str(load.key.id))
+                    load_line["kind"] = constants.loads
+                    yield render.dumps(load_line) + "\n"
+
+        if not page.next_cursor:
+            return
+        cursor = page.next_cursor
+
+
+@bp.route('/export', methods=['GET'])
+def export_boats():
+    # Checks if JWT was provided in Authorization header
+    sub = check_jwt(request.headers)
+
+    if not isinstance(sub, str):
+        return sub
+
+    # Lines are written to the client as they are produced rather than built into one body
+    return Response(export_lines(sub, request.root_url), mimetype='application/x-ndjson')
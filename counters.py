@@ -0,0 +1,99 @@
+from flask import Blueprint, request, make_response
+from google.cloud import datastore
+from collections import Counter
+from repository import repo
+import random
+import constants
+import query_guard
+
+bp = Blueprint('counters', __name__, url_prefix='/counters')
+
+# Each counter is split over NUM_SHARDS entities so concurrent writers rarely touch the same one
+COUNTER_KIND = "counter_shards"
+NUM_SHARDS = 20
+
+# Counter names
+LOADS = "loads"
+USERS = "users"
+
+
+def boats_counter(owner):
+    return "boats:" + owner
+
+
+def shard_key(name, shard):
+    return repo.key(COUNTER_KIND, "{}-{}".format(name, shard))
+
+
+def increment(name, delta=1):
+    """Adds delta to a random shard of the counter, inside the current transaction if there is one"""
+    if not repo.in_transaction():
+        with repo.transaction():
+            increment(name, delta)
+        return
+
+    key = shard_key(name, random.randrange(NUM_SHARDS))
+    shard = repo.get(key)
+
+    if shard is None:
+        shard = datastore.entity.Entity(key=key)
+        shard.update({"name": name, "count": 0})
+
+    shard["count"] += delta
+    repo.put(shard)
+
+
+def total(name):
+    # One batched lookup of every shard instead of enumerating the counted entities
+    shards = repo.get_multi([shard_key(name, shard) for shard in range(NUM_SHARDS)])
+    return sum(shard["count"] for shard in shards)
+
+
+def set_total(name, count):
+    """Overwrites the counter so that its shards add up to count"""
+    shards = []
+    for shard in range(NUM_SHARDS):
+        entity = datastore.entity.Entity(key=shard_key(name, shard))
+        entity.update({"name": name, "count": count if shard == 0 else 0})
+        shards.append(entity)
+
+    with repo.transaction():
+        repo.put_multi(shards)
+
+
+def repair():
+    """Recounts every counted collection and rewrites its counter; returns the corrected totals"""
+    totals = Counter()
+
+    # Every counter seen so far starts from zero, so counters of emptied collections are reset too
+    for shard in repo.scan(COUNTER_KIND):
+        totals[shard["name"]] = 0
+
+    totals[LOADS] = repo.count(constants.loads)
+    totals[USERS] = repo.count(constants.users)
+
+    # Only the owner is read for each boat
+    for boat in repo.scan(constants.boats, projection=["owner"]):
+        totals[boats_counter(boat["owner"])] += 1
+
+    for name, count in totals.items():
+        set_total(name, count)
+
+    return dict(totals)
+
+
+@bp.route('/repair', methods=['GET'])
+@query_guard.allow_whole_kind
+def repair_counters():
+    # Only App Engine cron may trigger the repair; the header is stripped from external requests
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        err = {"Error": "This endpoint is only available to cron jobs"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 403
+        return res
+
+    res = make_response({"totals": repair()})
+    res.headers.set('Content-Type', 'application/json')
+    res.status_code = 200
+    return res
@@ -0,0 +1,104 @@
+from ttl_cache import TTLCache
+import copy
+import json
+import os
+import pickle
+
+# Seconds a cached entity may be served for; writes invalidate it sooner
+DEFAULT_TTL = int(os.environ.get('ENTITY_CACHE_TTL', '60'))
+DEFAULT_CAPACITY = int(os.environ.get('ENTITY_CACHE_CAPACITY', '10000'))
+
+# Seconds an invalidated key refuses to be filled again. A reader that fetched the entity before a
+# write cannot cache that old copy after the write's invalidation, unless the read took longer.
+TOMBSTONE_TTL = float(os.environ.get('ENTITY_CACHE_TOMBSTONE_TTL', '5'))
+
+# Stored in place of an invalidated entity
+TOMBSTONE = b"tombstone"
+
+
+def cache_key(key):
+    # The flat path keeps numeric ids and names apart, e.g. ["boats", 5] vs ["boats", "5"]
+    return "entity:" + json.dumps(key.flat_path)
+
+
+class LocalCache:
+    """Process-local entity cache with TTL and LRU bounds
+
+    Invalidated keys hold a tombstone for TOMBSTONE_TTL seconds, which add does not overwrite.
+    """
+
+    def __init__(self, ttl=DEFAULT_TTL, capacity=DEFAULT_CAPACITY, tombstone_ttl=TOMBSTONE_TTL):
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.entries = TTLCache(capacity=capacity)
+
+    def get(self, key):
+        # Copies in and out, so callers adding id/self never touch the cached entity
+        entity = self.entries.get(key)
+        return copy.deepcopy(entity) if entity is not None and entity is not TOMBSTONE else None
+
+    def add(self, key, entity):
+        # Fills a miss, unless the key was invalidated since the reader missed
+        self.entries.add(key, copy.deepcopy(entity), expires_at=self.entries.clock() + self.ttl)
+
+    def delete_many(self, keys):
+        expires_at = self.entries.clock() + self.tombstone_ttl
+        for key in keys:
+            self.entries.set(key, TOMBSTONE, expires_at=expires_at)
+
+    def stats(self):
+        return self.entries.stats()
+
+
+class RedisCache:
+    """Entity cache shared between processes, on Redis or any server speaking its protocol
+
+    Invalidated keys hold a tombstone for TOMBSTONE_TTL seconds, which add does not overwrite.
+    """
+
+    def __init__(self, url, ttl=DEFAULT_TTL, tombstone_ttl=TOMBSTONE_TTL):
+        # Optional dependency, only needed when a redis:// cache URL is configured
+        import redis
+
+        self.ttl = ttl
+        self.tombstone_ttl = tombstone_ttl
+        self.client = redis.Redis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.client.get(key)
+        if value is None or value == TOMBSTONE:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return pickle.loads(value)
+
+    def add(self, key, entity):
+        # SET NX leaves a tombstone, or a newer entity, in place
+        self.client.set(key, pickle.dumps(entity), ex=self.ttl, nx=True)
+
+    def delete_many(self, keys):
+        if not keys:
+            return
+
+        pipeline = self.client.pipeline(transaction=False)
+        for key in keys:
+            pipeline.set(key, TOMBSTONE, px=int(self.tombstone_ttl * 1000))
+        pipeline.execute()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def create_cache(url=None):
+    """Builds the cache named by url or ENTITY_CACHE_URL: unset for local, "none" to disable, or redis://"""
+    url = url if url is not None else os.environ.get('ENTITY_CACHE_URL', '')
+
+    if url == 'none':
+        return None
+    if url.startswith('redis://') or url.startswith('rediss://') or url.startswith('unix://'):
+        return RedisCache(url)
+    if url in ('', 'local'):
+        return LocalCache()
+    raise ValueError("Unknown entity cache: {}".format(url))
@@ -0,0 +1,36 @@
+from flask import request
+import hashlib
+import json
+
+
+class PreconditionFailed(Exception):
+    """Raised inside a write transaction when the stored entity no longer matches the request's If-Match"""
+
+
+def entity_etag(entity):
+    """Strong ETag derived from the entity's key and stored content (not the id/self added for responses)"""
+    content = json.dumps([entity.key.flat_path, dict(entity)], sort_keys=True, default=str)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+
+def if_match_failed(entity):
+    # True when the request carries If-Match and none of its tags is the entity's current ETag
+    return bool(request.if_match) and not request.if_match.contains(entity_etag(entity))
+
+
+def check_unchanged(stored, etag):
+    """Fails with PreconditionFailed if the entity, as re-read inside the write transaction, changed since it was matched
+
+    Nothing is checked when etag is None, i.e. the request carried no If-Match.
+    """
+    if etag is not None and entity_etag(stored) != etag:
+        raise PreconditionFailed()
+
+
+def conditional(res, etag=None):
+    """Sets a strong ETag (the given one or a digest of the body) and answers 304 on If-None-Match"""
+    if etag:
+        res.set_etag(etag)
+    else:
+        res.add_etag()
+    return res.make_conditional(request)
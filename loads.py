@@ -1,14 +1,183 @@
 from flask import Blueprint, request, make_response
 from google.cloud import datastore
-import json
-from datetime import datetime
-from string import ascii_letters, digits, whitespace
+from google.api_core.exceptions import Conflict
+from repository import repo
 import constants
-
-client = datastore.Client()
+import counters
+import pagination
+import etags
+import render
+import validation
+import json
 
 bp = Blueprint('loads', __name__, url_prefix='/loads')
 
+# Flask joins a blueprint's prefix and its rules with "/", so /loads:batch needs a prefix-less blueprint
+batch_bp = Blueprint('loads_batch', __name__)
+
+# Most loads accepted by one batch request
+MAX_BATCH_ITEMS = 5000
+
+# Datastore commits at most 500 mutations; each batch transaction also writes one counter shard
+BATCH_COMMIT_SIZE = 499
+
+# Stands in for an NDJSON line that is not valid JSON
+UNPARSEABLE = object()
+
+
+def save_load(load_key, changes, expected_etag=None):
+    """Applies changes to the load as stored now, re-read inside the transaction
+
+    The carrier always comes from that fresh copy, so a concurrent load/unload is kept. Returns the
+    saved load, or None if it no longer exists. With expected_etag it fails with PreconditionFailed
+    if the stored load differs.
+    """
+    load = repo.get(load_key)
+    if load is None:
+        return None
+
+    etags.check_unchanged(load, expected_etag)
+
+    load.update(changes)
+    repo.put(load)
+    return load
+
+
+def load_error(content):
+    """Returns the error body for content if it is not a valid new load, or None when it is"""
+    errors = validation.LOAD.validate(content)
+    return validation.error_body(errors) if errors else None
+
+
+def read_batch():
+    """Parses the batch body, a JSON array or NDJSON, into a list of items
+
+    NDJSON lines that are not valid JSON become UNPARSEABLE, so they are reported as such instead
+    of failing the whole batch. Returns None when a JSON body is not an array.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(UNPARSEABLE)
+        return items
+
+    content = request.get_json(silent=True)
+    return content if isinstance(content, list) else None
+
+
+def insert_loads(new_loads):
+    """Writes the new loads and adds them to the loads counter in the current transaction"""
+    repo.put_multi(new_loads)
+    counters.increment(counters.LOADS, len(new_loads))
+
+
+def create_loads(contents):
+    """Writes the new loads with put_multi in commit-sized chunks and returns their keys
+
+    Each chunk is its own transaction, retried on contention. The key of every load in a chunk
+    that still could not be committed is None, since the chunks before it are already written.
+    """
+    keys = repo.allocate_ids(constants.loads, len(contents)) if contents else []
+
+    new_loads = []
+    for key, content in zip(keys, contents):
+        new_load = datastore.entity.Entity(key=key)
+        new_load.update({"volume": content["volume"], "carrier": None, "item": content["item"],
+                         "creation_date": content["creation_date"]})
+        new_loads.append(new_load)
+
+    # Each chunk and its counter increment are written together
+    for start in range(0, len(new_loads), BATCH_COMMIT_SIZE):
+        chunk = new_loads[start:start + BATCH_COMMIT_SIZE]
+        try:
+            repo.run_in_transaction(insert_loads, chunk)
+        except Conflict:
+            keys[start:start + len(chunk)] = [None] * len(chunk)
+
+    return keys
+
+
+@batch_bp.route('/loads:batch', methods=['POST'])
+def loads_batch_post():
+    if request.mimetype not in ('application/json', 'application/x-ndjson'):
+        # Checks if sent data is json or ndjson, if not return 415
+        err = {"Error": "The request header 'content_type' is not application/json or application/x-ndjson"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 415
+        return res
+
+    elif 'application/json' not in request.accept_mimetypes:
+        # Checks if client accepts json, if not return 406
+        err = {"Error": "The request header ‘Accept' is not application/json"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 406
+        return res
+
+    items = read_batch()
+
+    if items is None:
+        err = {"Error": "The request body is not a JSON array of loads"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 400
+        return res
+
+    elif len(items) > MAX_BATCH_ITEMS:
+        err = {"Error": "The batch has more than " + str(MAX_BATCH_ITEMS) + " loads"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 413
+        return res
+
+    # Every item is validated; only the valid ones are written
+    results = []
+    valid = []
+    for index, content in enumerate(items):
+        error = {"Error": "The line is not valid JSON"} if content is UNPARSEABLE else load_error(content)
+        if error:
+            results.append(dict(error, index=index, status=400))
+        else:
+            results.append({"index": index, "status": 201})
+            valid.append((index, content))
+
+    keys = create_loads([content for index, content in valid])
+
+    # Loads of a chunk that kept aborting are reported as conflicts, so the client can resend just those
+    load_url = request.host_url + "loads/"
+    created = 0
+    for (index, content), key in zip(valid, keys):
+        if key is None:
+            results[index].update({"Error": "The load was not written because of concurrent requests", "status": 409})
+        else:
+            results[index].update({"id": key.id, "self": load_url + str(key.id)})
+            created += 1
+
+    return render.json_response({"created": created, "failed": len(items) - created, "results": results})
+
+
+def remove_load(load_key):
+    """Deletes the load and takes it off its boat; returns False if there is no such load"""
+    load = repo.get(load_key)
+    if load is None:
+        return False
+
+    if load['carrier']:
+        boat = repo.get(repo.key(constants.boats, int(load['carrier']['id'])))
+        if boat is not None:
+            boat['loads'] = [load_item for load_item in boat['loads'] if load_item['id'] != str(load_key.id)]
+            repo.put(boat)
+
+    repo.delete(load_key)
+    counters.increment(counters.LOADS, -1)
+    return True
+
 
 @bp.route('', methods=['POST', 'GET'])
 def loads_get_post():
@@ -42,48 +211,30 @@ def loads_get_post():
             res.status_code = 415
             return res
 
-        # Check contents of the json file to make sure keys have values, and it is not empty.
+        # Check contents of the json file to make sure every attribute is present and valid.
         # Only supported attributes will be used. Any additional ones will be ignored.
-        if not content or "item" not in content or "volume" not in content or "creation_date" not in content:
-            err = {"Error": "The request object is missing at least one of the required attributes"}
-            res = make_response(err)
+        errors = validation.LOAD.validate(content)
+        if errors:
+            res = make_response(validation.error_body(errors))
             res.headers.set('Content-Type', 'application/json')
             res.status_code = 400
             return res
 
-        # Check value of contents to make sure they are not null or have valid characters.
-        if set(content["item"]).difference(ascii_letters + digits + whitespace) \
-                or not isinstance(content["volume"], int) or len(content["creation_date"]) != 10:
-            err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-            res = make_response(err)
-            res.headers.set('Content-Type', 'application/json')
-            res.status_code = 400
-            return res
+        new_load = datastore.entity.Entity(key=repo.key(constants.loads))
+        new_load.update({"volume": content["volume"], "carrier": None, "item": content["item"],
+                         "creation_date": content["creation_date"]})
 
-        # Source: https://www.programiz.com/python-programming/datetime/strftime
-        # Check date format
-        date_format = "%m/%d/%Y"
+        # The load and its counter are written together, retried on contention
         try:
-            datetime.strptime(content["creation_date"], date_format)
-        except ValueError:
-            err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
+            repo.run_in_transaction(insert_loads, [new_load])
+        except Conflict:
+            err = {"Error": "The load could not be created because of concurrent requests"}
             res = make_response(err)
             res.headers.set('Content-Type', 'application/json')
-            res.status_code = 400
+            res.status_code = 409
             return res
 
-        new_load = datastore.entity.Entity(key=client.key(constants.loads))
-        new_load.update({"volume": content["volume"], "carrier": None, "item": content["item"],
-                         "creation_date": content["creation_date"]})
-        client.put(new_load)
-
-        new_load["id"] = new_load.key.id
-        new_load["self"] = request.base_url + "/" + str(new_load.key.id)
-
-        res = make_response(json.dumps(new_load))
-        res.mimetype = 'application/json'
-        res.status_code = 201
-        return res
+        return render.json_response(render.entity(new_load, request.base_url + "/" + str(new_load.key.id)), 201)
 
     elif request.method == 'GET':
 
@@ -95,44 +246,29 @@ def loads_get_post():
             res.status_code = 406
             return res
 
-        # Get query of loads and set the limit and offset for the query
-        query = client.query(kind=constants.loads)
-        total_loads = list(query.fetch(query.keys_only()))
-
-        # Reset the query to show the objects
-        query = client.query(kind=constants.loads)
-        q_limit = int(request.args.get('limit', '5'))
-        q_offset = int(request.args.get('offset', '0'))
-
-        # Get result of query and make into a list
-        load_iterator = query.fetch(limit=q_limit, offset=q_offset)
-        pages = load_iterator.pages
-        results = list(next(pages))
-
-        # Create a "next" url page using
-        if load_iterator.next_page_token:
-            next_offset = q_offset + q_limit
-            next_url = request.base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
-        else:
-            next_url = None
+        # The load count comes from its sharded counter instead of enumerating keys
+        total_loads = counters.total(counters.LOADS)
 
-        # Adds id key and value to each json slip; add next url
-        for load in results:
-            load["id"] = load.key.id
-            load["self"] = request.base_url + "/" + str(load.key.id)
+        # Get one page of loads, by cursor or by limit and offset, and its "next" url
+        try:
+            results, next_url = pagination.fetch_page(constants.loads, [], request.args, request.base_url)
+        except pagination.InvalidCursor:
+            res = make_response(pagination.INVALID_CURSOR)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 400
+            return res
 
-        output = {"loads": results}
+        # Adds id key and value to each json load; add next url
+        output = {"loads": render.entities(results, request.base_url)}
 
         # There is a next_url
         if next_url:
             output["next"] = next_url
 
-        output["total_loads"] = len(total_loads)
+        output["total_loads"] = total_loads
 
-        res = make_response(json.dumps(output))
-        res.headers.set('Content-Type', 'application/json')
-        res.status_code = 200
-        return res
+        # Sends json response, or 304 if the client already has this page
+        return etags.conditional(render.json_response(output))
 
     else:
         # Status code 405
@@ -176,8 +312,8 @@ def loads_get_put_delete(lid):
             res.status_code = 415
             return res
 
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
+        load_key = repo.key(constants.loads, int(lid))
+        load = repo.get(load_key)
 
         # Checks if load with load_id exists
         if not load:
@@ -187,73 +323,75 @@ def loads_get_put_delete(lid):
             res.status_code = 404
             return res
 
-        # Check contents of the json file to make sure keys have values, and it is not empty.
-        # Only supported attributes will be used. Any additional ones will be ignored.
-        if not content or "volume" not in content or "item" not in content or "creation_date" not in content:
-            err = {"Error": "The request object is missing at least one of the required attributes"}
+        # If-Match must name the load's current ETag, so a client cannot overwrite changes it has not seen
+        elif etags.if_match_failed(load):
+            err = {"Error": "The load has been modified since it was last retrieved"}
             res = make_response(err)
             res.headers.set('Content-Type', 'application/json')
-            res.status_code = 400
+            res.status_code = 412
             return res
 
-        # Check value of contents to make sure they are not null or have valid characters.
-        if set(content["item"]).difference(ascii_letters + digits + whitespace) \
-                or not isinstance(content["volume"], int) or len(content["creation_date"]) != 10:
-            err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-            res = make_response(err)
+        expected_etag = etags.entity_etag(load) if request.if_match else None
+
+        # Check contents of the json file to make sure every attribute is present and valid.
+        # Only supported attributes will be used. Any additional ones will be ignored.
+        errors = validation.LOAD.validate(content)
+        if errors:
+            res = make_response(validation.error_body(errors))
             res.headers.set('Content-Type', 'application/json')
             res.status_code = 400
             return res
 
-        # Check date format
-        date_format = "%m/%d/%Y"
+        # Updates the load re-read in the transaction, retried on contention
+        changes = {"volume": content["volume"], "item": content["item"], "creation_date": content["creation_date"]}
         try:
-            datetime.strptime(content["creation_date"], date_format)
-        except ValueError:
-            err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
+            load = repo.run_in_transaction(save_load, load_key, changes, expected_etag)
+        except etags.PreconditionFailed:
+            err = {"Error": "The load has been modified since it was last retrieved"}
             res = make_response(err)
             res.headers.set('Content-Type', 'application/json')
-            res.status_code = 400
+            res.status_code = 412
+            return res
+
+        except Conflict:
+            err = {"Error": "The load was modified by another request"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
             return res
 
-        # Updates the load
-        load.update({"volume": content["volume"], "item": content["item"],
-                     "creation_date": content["creation_date"]})
-        client.put(load)
+        if load is None:
+            err = {"Error": "No load with this load_id exists"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 404
+            return res
 
-        res = make_response(json.dumps(load))
-        res.mimetype = 'application/json'
-        res.status_code = 200
+        res = render.json_response(load)
+        res.set_etag(etags.entity_etag(load))
         return res
 
     elif request.method == 'DELETE':
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
+        load_key = repo.key(constants.loads, int(lid))
+
+        # The load, its boat's loads list and the counter change together, retried on contention
+        try:
+            deleted = repo.run_in_transaction(remove_load, load_key)
+        except Conflict:
+            err = {"Error": "The load was modified by another request"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
+            return res
 
         # Checks if load with load_id exists
-        if not load:
+        if not deleted:
             err = {"Error": "No load with this load_id exists"}
             res = make_response(err)
             res.headers.set('Content-Type', 'application/json')
             res.status_code = 404
             return res
 
-        if load['carrier']:
-            # Gets boat with load
-            bid = load['carrier']['id']
-            boat_key = client.key(constants.boats, int(bid))
-            boat = client.get(key=boat_key)
-
-            # Find index in loads list where lid is located
-            boat_check = next((index for index, load in enumerate(boat['loads'])
-                               if load['id'] == lid), None)
-
-            # Delete load from loads in the boat
-            del boat['loads'][boat_check]
-            client.put(boat)
-
-        client.delete(load_key)
-
         res = make_response()
         res.status_code = 204
         return res
@@ -289,8 +427,8 @@ def loads_get_put_delete(lid):
             res.status_code = 415
             return res
 
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
+        load_key = repo.key(constants.loads, int(lid))
+        load = repo.get(load_key)
 
         # Checks if load with load_id exists
         if not load:
@@ -300,58 +438,50 @@ def loads_get_put_delete(lid):
             res.status_code = 404
             return res
 
-        # If any or all of the 3 attributes are provided, they are updated.
-        if "item" in content and content["item"]:
-            # Check value of contents to make sure they are not null or have valid characters.
-            if set(content["item"]).difference(ascii_letters + digits + whitespace):
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
-
-            # Load name is updated
-            load.update({"item": content["item"]})
-
-        if "volume" in content and content["volume"]:
-            # Check value of contents to make sure they are not null or have valid characters.
-            if not isinstance(content["volume"], int):
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
-
-            load.update({"volume": content["volume"]})
-
-        if "creation_date" in content and content["creation_date"]:
-            # Check value of contents to make sure they are not null or have valid characters.
-
-            date_format = "%m/%d/%Y"
-
-            if len(content["creation_date"]) != 10:
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
+        # If-Match must name the load's current ETag, so a client cannot overwrite changes it has not seen
+        elif etags.if_match_failed(load):
+            err = {"Error": "The load has been modified since it was last retrieved"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 412
+            return res
+
+        expected_etag = etags.entity_etag(load) if request.if_match else None
 
-            try:
-                datetime.strptime(content["creation_date"], date_format)
-            except ValueError:
-                err = {"Error": "The request object has at least one invalid value assigned to an attribute"}
-                res = make_response(err)
-                res.headers.set('Content-Type', 'application/json')
-                res.status_code = 400
-                return res
+        # If any or all of the 3 attributes are provided, they are all checked and then updated.
+        errors = validation.LOAD.validate(content, partial=True)
+        if errors:
+            res = make_response(validation.error_body(errors))
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 400
+            return res
 
-            load.update({"creation_date": content["creation_date"]})
+        # Updates the load re-read in the transaction, retried on contention
+        try:
+            load = repo.run_in_transaction(save_load, load_key, validation.LOAD.updates(content), expected_etag)
+        except etags.PreconditionFailed:
+            err = {"Error": "The load has been modified since it was last retrieved"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 412
+            return res
+
+        except Conflict:
+            err = {"Error": "The load was modified by another request"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 409
+            return res
 
-        client.put(load)
+        if load is None:
+            err = {"Error": "No load with this load_id exists"}
+            res = make_response(err)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 404
+            return res
 
-        res = make_response(json.dumps(load))
-        res.mimetype = 'application/json'
-        res.status_code = 200
+        res = render.json_response(load)
+        res.set_etag(etags.entity_etag(load))
         return res
 
     elif request.method == 'GET':
@@ -364,21 +494,18 @@ def loads_get_put_delete(lid):
             res.status_code = 406
             return res
 
-        load_key = client.key(constants.loads, int(lid))
-        load = client.get(key=load_key)
+        load_key = repo.key(constants.loads, int(lid))
+        # Hot entities are served from the read-through cache, which writes invalidate
+        load = repo.get_cached(load_key)
 
         # Check if load exists
         if not load:
             return {"Error": "No load with this load_id exists"}, 404
 
-        load["id"] = load.key.id
-        load["self"] = request.base_url
-
-        # Sends json response
-        res = make_response(json.dumps(load))
-        res.headers.set('Content-Type', 'application/json')
-        res.status_code = 200
-        return res
+        # Sends json response, or 304 if the client already has this version.
+        # The ETag covers the stored load, not the id and self added for the response.
+        res = render.json_response(render.entity(load, request.base_url))
+        return etags.conditional(res, etags.entity_etag(load))
 
     else:
         # Status code 405
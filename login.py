@@ -1,22 +1,72 @@
 from flask import Blueprint, request, redirect, make_response
 from google.cloud import datastore
+from datetime import datetime, timedelta, timezone
 from state_generator import state_gen
+from repository import repo
 import constants
 
-client = datastore.Client()
-
 bp = Blueprint('login', __name__, url_prefix='/login')
 
+# States older than this are rejected by the callback and removed by the sweep
+STATE_TTL = timedelta(minutes=30)
+
+# Datastore accepts at most 500 keys per delete_multi
+SWEEP_BATCH_SIZE = 500
+
+
+def state_expired(state):
+    created = state.get("created")
+    return created is None or created < datetime.now(timezone.utc) - STATE_TTL
+
+
+def sweep_expired_states(batch_size=SWEEP_BATCH_SIZE):
+    """Deletes every state older than STATE_TTL, and any legacy state, in batches; returns how many were removed"""
+    cutoff = datetime.now(timezone.utc) - STATE_TTL
+    deleted = 0
+
+    while True:
+        page = repo.query(constants.states, filters=[("created", "<", cutoff)], keys_only=True, limit=batch_size)
+        keys = [entity.key for entity in page.entities]
+
+        if not keys:
+            break
+
+        repo.delete_multi(keys)
+        deleted += len(keys)
+
+    return deleted + sweep_legacy_states(batch_size)
+
+
+def sweep_legacy_states(batch_size=SWEEP_BATCH_SIZE):
+    """Deletes states stored before they were keyed by name; returns how many were removed
+
+    Those have numeric ids and no created time, so the created filter never finds them. Numeric
+    ids sort before every name, so a keys-only key range reaches only them and is empty once
+    they are gone.
+    """
+    first_name_key = repo.key(constants.states, "0")
+    deleted = 0
+
+    while True:
+        page = repo.query(constants.states, filters=[("__key__", "<", first_name_key)], keys_only=True,
+                          limit=batch_size)
+        keys = [entity.key for entity in page.entities if entity.key.id is not None]
+
+        if not keys:
+            return deleted
+
+        repo.delete_multi(keys)
+        deleted += len(keys)
+
 
 @bp.route('', methods=['GET'])
 def authorize_signin():
     if request.method == 'GET':
-        # Get query of loads and set the limit and offset for the query
-        # Name of boat must be unique
-        new_user = datastore.entity.Entity(key=client.key(constants.states))
+        # The state string is the key name, so the callback can reach it with a single keyed get
         new_state = state_gen()
-        new_user.update({"state": new_state})
-        client.put(new_user)
+        new_user = datastore.entity.Entity(key=repo.key(constants.states, new_state))
+        new_user.update({"state": new_state, "created": datetime.now(timezone.utc)})
+        repo.put(new_user)
 
         oauth_url = ('https://accounts.google.com/o/oauth2/v2/auth?response_type=code'
                 '&client_id={}&redirect_uri={}&scope={}&state={}')\
@@ -31,3 +81,19 @@ def authorize_signin():
         res.headers.set('Content-Type', 'text/html')
         res.status_code = 405
         return res
+
+
+@bp.route('/sweep', methods=['GET'])
+def sweep_states():
+    # Only App Engine cron may trigger the sweep; the header is stripped from external requests
+    if request.headers.get('X-Appengine-Cron') != 'true':
+        err = {"Error": "This endpoint is only available to cron jobs"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 403
+        return res
+
+    res = make_response({"deleted": sweep_expired_states()})
+    res.headers.set('Content-Type', 'application/json')
+    res.status_code = 200
+    return res
@@ -1,18 +1,34 @@
 from flask import Flask, render_template
+from repository import repo
 import boats
 import loads
 import login
 import oauth
 import users
 import slips
+import counters
+import metrics
+import query_guard
+import transport
 
 app = Flask(__name__)
 app.register_blueprint(boats.bp)
 app.register_blueprint(loads.bp)
+app.register_blueprint(loads.batch_bp)
 app.register_blueprint(slips.bp)
 app.register_blueprint(login.bp)
 app.register_blueprint(oauth.bp)
 app.register_blueprint(users.bp)
+app.register_blueprint(counters.bp)
+
+# Request latency, datastore calls per request, section timings and cache hit rates, served on /metrics
+metrics.init_app(app, repo)
+metrics.register_cache("jwt", boats.jwt_cache.stats)
+metrics.register_cache("certs", transport.auth_request.cache.stats)
+metrics.register_cache("user_keys", users.user_keys.stats)
+
+# With QUERY_GUARD=log or raise, requests making datastore calls in loops or reading whole kinds are reported
+query_guard.init_app(app, repo)
 
 
 @app.route('/')
@@ -21,5 +37,12 @@ def index():
         'index.html')
 
 
+@app.route('/_ah/warmup')
+def warmup():
+    # App Engine calls this before routing traffic to a new instance
+    repo.warmup()
+    return '', 200
+
+
 if __name__ == '__main__':
     app.run(host='127.0.0.1', port=8080, debug=True)
@@ -0,0 +1,202 @@
+from flask import Blueprint, g, has_request_context, request, make_response
+from contextlib import contextmanager
+import bisect
+import threading
+import time
+
+bp = Blueprint('metrics', __name__)
+
+# Upper bounds (seconds) of the latency buckets, and of the datastore-calls-per-request buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+RPC_COUNT_BUCKETS = (0, 1, 2, 5, 10, 25, 50, 100, 250, 1000)
+
+# Addresses allowed to read /metrics
+LOCAL_ADDRESSES = ('127.0.0.1', '::1')
+
+
+class Histogram:
+    """Cumulative-bucket histogram in the shape Prometheus expects"""
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield "{}_bucket{} {}".format(name, format_labels(labels + (("le", str(bound)),)), cumulative)
+        yield "{}_sum{} {}".format(name, format_labels(labels), self.sum)
+        yield "{}_count{} {}".format(name, format_labels(labels), self.count)
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(name, escape(value)) for name, value in labels) + "}"
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    """Process-local metrics, keyed by their label values"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Cache name -> callable returning its stats dict (hits, misses and, for local caches, size)
+        self.caches = {}
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = {}
+            self.request_rpcs = {}
+            self.rpcs = {}
+            self.sections = {}
+            self.transactions = {}
+            self.retries = {}
+
+    def observe(self, table, labels, buckets, value):
+        with self.lock:
+            histogram = table.get(labels)
+            if histogram is None:
+                histogram = table[labels] = Histogram(buckets)
+            histogram.observe(value)
+
+    def increment(self, table, labels, amount=1):
+        with self.lock:
+            table[labels] = table.get(labels, 0) + amount
+
+    def render(self):
+        """The registry in the Prometheus text exposition format"""
+        families = (
+            ("http_request_duration_seconds", "Request latency by route, method and status", self.requests),
+            ("http_request_datastore_calls", "Datastore calls made by one request, by route", self.request_rpcs),
+            ("datastore_call_duration_seconds", "Datastore call latency by operation", self.rpcs),
+            ("section_duration_seconds", "Time spent in instrumented sections such as check_jwt", self.sections),
+        )
+
+        counters = (
+            ("datastore_transactions_total", "Retried transactions by name and outcome", self.transactions),
+            ("datastore_transaction_retries_total", "Attempts repeated after contention, by transaction", self.retries),
+        )
+
+        # Cache stats are read when scraped, from each cache's own counters
+        cache_families = (
+            ("cache_hits_total", "Lookups answered from the cache, by cache", "counter", "hits"),
+            ("cache_misses_total", "Lookups the cache could not answer, by cache", "counter", "misses"),
+            ("cache_entries", "Entries held by a process-local cache, by cache", "gauge", "size"),
+        )
+
+        lines = []
+        with self.lock:
+            cache_stats = {name: stats() for name, stats in sorted(self.caches.items())}
+            for name, description, table in families:
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} histogram".format(name))
+                for labels in sorted(table):
+                    lines.extend(table[labels].lines(name, labels))
+
+            for name, description, table in counters:
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} counter".format(name))
+                for labels in sorted(table):
+                    lines.append("{}{} {}".format(name, format_labels(labels), table[labels]))
+
+            for name, description, metric_type, field in cache_families:
+                lines.append("# HELP {} {}".format(name, description))
+                lines.append("# TYPE {} {}".format(name, metric_type))
+                for cache, stats in cache_stats.items():
+                    if field in stats:
+                        lines.append("{}{} {}".format(name, format_labels((("cache", cache),)), stats[field]))
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
+
+
+def register_cache(name, stats):
+    """Adds a cache to /metrics; stats() returns its hits and misses, and size if it has one"""
+    with registry.lock:
+        registry.caches[name] = stats
+
+
+def route_label():
+    # The rule (/boats/<bid>) rather than the path keeps one series per route
+    return request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+
+def record_call(operation, args, seconds):
+    """Repository listener: times every datastore call and counts it against the current request"""
+    registry.observe(registry.rpcs, (("operation", operation),), LATENCY_BUCKETS, seconds)
+
+    if has_request_context() and 'metrics_rpcs' in g:
+        g.metrics_rpcs += 1
+
+
+def record_transaction(name, attempts, committed):
+    """Repository transaction listener: counts outcomes and contention retries of run_in_transaction"""
+    outcome = "committed" if committed else "gave_up"
+    registry.increment(registry.transactions, (("transaction", name), ("outcome", outcome)))
+    if attempts > 1:
+        registry.increment(registry.retries, (("transaction", name),), attempts - 1)
+
+
+@contextmanager
+def timed(section):
+    """Records the time spent in a block, or a function when used as a decorator"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        registry.observe(registry.sections, (("section", section),), LATENCY_BUCKETS, time.perf_counter() - start)
+
+
+def start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_rpcs = 0
+
+
+def finish_request(res):
+    if 'metrics_start' in g:
+        route = route_label()
+        labels = (("route", route), ("method", request.method), ("status", str(res.status_code)))
+        registry.observe(registry.requests, labels, LATENCY_BUCKETS, time.perf_counter() - g.metrics_start)
+        registry.observe(registry.request_rpcs, (("route", route),), RPC_COUNT_BUCKETS, g.metrics_rpcs)
+    return res
+
+
+def init_app(app, repo):
+    """Times every request of app and counts the datastore calls repo makes for it"""
+    app.before_request(start_request)
+    app.after_request(finish_request)
+    app.register_blueprint(bp)
+    repo.listeners.append(record_call)
+    repo.transaction_listeners.append(record_transaction)
+
+    if repo.cache is not None:
+        register_cache("entity", repo.cache.stats)
+
+
+@bp.route('/metrics', methods=['GET'])
+def get_metrics():
+    # Only scrapers on the same host may read the metrics
+    if request.remote_addr not in LOCAL_ADDRESSES:
+        err = {"Error": "Metrics are only served to local clients"}
+        res = make_response(err)
+        res.headers.set('Content-Type', 'application/json')
+        res.status_code = 403
+        return res
+
+    res = make_response(registry.render())
+    res.headers.set('Content-Type', 'text/plain; version=0.0.4')
+    return res
@@ -1,82 +1,74 @@
 from flask import Blueprint, request, redirect, make_response, render_template, url_for
-from google.cloud import datastore
+from login import state_expired
+from state_generator import is_state
+from repository import repo
+import asyncio
 import constants
-from google.oauth2 import id_token
-from google.auth.transport import requests as req
-import requests
-
-client = datastore.Client()
+import transport
+import users
 
 bp = Blueprint('oauth', __name__, url_prefix='/oauth')
 
 
+def user_details(res_token):
+    # Get user details
+    headers = {'Authorization': 'Bearer {}'.format(res_token['access_token'])}
+    return transport.get(constants.people_url, headers=headers).json()
+
+
 @bp.route('')
-def token_user_details():
+async def token_user_details():
+    """OAuth callback; independent network calls run concurrently in worker threads
+
+    The People API fetch and the id_token check overlap, as do the state delete and the
+    user upsert, so a login waits on the slowest call of each pair rather than their sum.
+    """
     if 'code' and 'state' not in request.args:
         return redirect(request.root_url + 'login')
 
-    else:
-        query = client.query(kind=constants.states)
-        states_list = list(query.fetch())
-
-        # Search all boat objects and compare the names to make sure they are unique
-        for curr_state in states_list:
-            if curr_state['state'] == request.args.get('state'):
-                data = {'code': request.args.get('code'),
-                        'client_id': constants.client_id,
-                        'client_secret': constants.secret,
-                        'redirect_uri': constants.redirect_uri,
-                        'grant_type': 'authorization_code',
-                        'access_type': 'offline'}
-
-                # POST method for token
-                res_token = requests.post('https://oauth2.googleapis.com/token', data=data).json()
-
-                # Get user details
-                headers = {'Authorization': 'Bearer {}'.format(res_token['access_token'])}
-                res_user = requests.get(constants.people_url, headers=headers).json()
-
-                print(res_token, res_user)
-
-                sub = id_token.verify_oauth2_token(
-                                res_token['id_token'], req.Request(), constants.client_id)['sub']
-
-                content = None
-                for e in res_user['names']:
-                    if e['givenName'] and e['familyName']:
-                        content = {
-                            'first': e['givenName'],
-                            'last': e['familyName'],
-                            'jwt': res_token['id_token'],
-                            'sub': sub
-                        }
-                    break
-
-                # Delete state from database
-                state_key = client.key(constants.states, int(curr_state.key.id))
-                client.delete(state_key)
-
-                # Name of user must be unique
-                query = client.query(kind=constants.users)
-                user_list = list(query.fetch())
-
-                # Search all boat objects and compare the names to make sure they are unique
-                for curr_user in user_list:
-                    if curr_user["sub"] == content["sub"]:
-
-                        # Render user page
-                        return render_template('user_info.html', user=content)
-
-                # Create new user entity
-                new_user = datastore.entity.Entity(key=client.key(constants.users))
-                new_user.update({"first": content["first"], "last": content["last"], "sub": content["sub"]})
-                client.put(new_user)
-
-                # If I add user_id, then add these to return also self
-                # new_user["id"] = new_user.key.id
-                # new_user["self"] = request.base_url + "/" + str(new_user.key.id)
-
-                # Render user page
-                return render_template('user_info.html', user=content)
+    # Only strings state_gen could have made can name a state; others (empty, "__x__") make invalid keys
+    if not is_state(request.args.get('state')):
+        return redirect(request.root_url + 'login')
+
+    # States are stored under their own string, so one keyed get finds them
+    state_key = repo.key(constants.states, request.args.get('state'))
+    curr_state = await asyncio.to_thread(repo.get, state_key)
 
+    if not curr_state or state_expired(curr_state):
         return redirect(request.root_url + 'login')
+
+    data = {'code': request.args.get('code'),
+            'client_id': constants.client_id,
+            'client_secret': constants.secret,
+            'redirect_uri': constants.redirect_uri,
+            'grant_type': 'authorization_code',
+            'access_type': 'offline'}
+
+    # POST method for token
+    res_token = (await asyncio.to_thread(transport.post, transport.TOKEN_URL, data=data)).json()
+
+    # The People API and the id_token check both only need the token response
+    res_user, id_info = await asyncio.gather(
+        asyncio.to_thread(user_details, res_token),
+        asyncio.to_thread(transport.verify_oauth2_token, res_token['id_token'], constants.client_id))
+
+    sub = id_info['sub']
+
+    content = None
+    for e in res_user['names']:
+        if e['givenName'] and e['familyName']:
+            content = {
+                'first': e['givenName'],
+                'last': e['familyName'],
+                'jwt': res_token['id_token'],
+                'sub': sub
+            }
+        break
+
+    # Delete state from database while the user is created on first login (returning users are found by their sub)
+    await asyncio.gather(
+        asyncio.to_thread(repo.delete, state_key),
+        asyncio.to_thread(users.get_or_create_user, content["first"], content["last"], content["sub"]))
+
+    # Render user page
+    return render_template('user_info.html', user=content)
@@ -0,0 +1,48 @@
+from google.api_core.exceptions import InvalidArgument
+from urllib.parse import quote
+from repository import repo
+
+# Page size when the request does not ask for one
+DEFAULT_LIMIT = 5
+
+# Answer for a cursor argument that is not one of our next links
+INVALID_CURSOR = {"Error": "The cursor is not valid"}
+
+
+class InvalidCursor(Exception):
+    """Raised when the request's cursor argument is malformed or was not issued for this query"""
+
+
+def fetch_page(kind, filters, args, base_url, projection=()):
+    """Fetches one page of the kind and builds the "next" link for it
+
+    Sending a cursor argument (empty for the first page) opts into cursor paging, where the next
+    link carries the query's page token and every page costs the same as the first. Otherwise
+    the legacy limit/offset links are used, where Datastore still walks every skipped entity.
+    A projection reads only the named properties from the index instead of whole entities.
+    Raises InvalidCursor for a cursor that cannot be resumed.
+    """
+    q_limit = int(args.get('limit', str(DEFAULT_LIMIT)))
+
+    if 'cursor' in args:
+        # A tampered cursor fails to decode locally (ValueError) or is rejected by Datastore
+        try:
+            page = repo.query(kind, filters=filters, projection=projection, limit=q_limit,
+                              cursor=args.get('cursor') or None)
+        except (ValueError, InvalidArgument):
+            raise InvalidCursor()
+
+        if page.next_cursor:
+            return page.entities, base_url + "?limit=" + str(q_limit) + "&cursor=" + quote(page.next_cursor)
+
+        return page.entities, None
+
+    q_offset = int(args.get('offset', '0'))
+    page = repo.query(kind, filters=filters, projection=projection, limit=q_limit, offset=q_offset)
+
+    # Create a "next" url page using the offset of the following page
+    if page.next_cursor:
+        next_offset = q_offset + q_limit
+        return page.entities, base_url + "?limit=" + str(q_limit) + "&offset=" + str(next_offset)
+
+    return page.entities, None
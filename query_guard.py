@@ -0,0 +1,182 @@
+from flask import g, request
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from functools import lru_cache
+import contextvars
+import logging
+import os
+import sys
+
+# Off unless QUERY_GUARD is "log" (report problems) or "raise" (fail the request, and so the test)
+MODE = os.environ.get('QUERY_GUARD', '')
+
+# Single-key calls of one operation on one kind from one call site allowed per request
+THRESHOLD = int(os.environ.get('QUERY_GUARD_THRESHOLD', '5'))
+
+# Unfiltered, unbounded fetches of a whole kind allowed per request
+WHOLE_KIND_THRESHOLD = int(os.environ.get('QUERY_GUARD_WHOLE_KIND', '0'))
+
+SINGLE_KEY_OPERATIONS = ('get', 'put', 'delete')
+
+# Frames from these files are the datastore plumbing, not the caller to blame. Paths are resolved,
+# since scripts that put e.g. benchmarks/.. on sys.path make co_filename a different spelling
+APP_DIR = os.path.dirname(os.path.realpath(__file__))
+PLUMBING_FILES = {os.path.join(APP_DIR, name) for name in ('repository.py', 'query_guard.py', 'metrics.py')}
+
+logger = logging.getLogger(__name__)
+
+# One datastore call: its operation and kind, whether it read a whole kind, and the app frames that made it
+Call = namedtuple('Call', ['operation', 'kind', 'whole_kind', 'site', 'stack'])
+
+# Calls recorded for the request (or watching block) running in this context
+current_calls = contextvars.ContextVar('query_guard_calls', default=None)
+
+
+class NPlusOneError(Exception):
+    """Raised in "raise" mode when a request makes datastore calls in a loop or reads a whole kind"""
+
+
+@lru_cache(maxsize=1024)
+def real_path(filename):
+    return os.path.realpath(filename)
+
+
+def frame_name(frame):
+    return "{}:{} in {}".format(os.path.relpath(real_path(frame.f_code.co_filename), APP_DIR), frame.f_lineno,
+                                frame.f_code.co_name)
+
+
+def call_stack():
+    # Innermost first, only frames of the app's own modules; callers outside the app (tests,
+    # scripts) fall back to the nearest frame that is not datastore plumbing
+    stack = []
+    outside = None
+    frame = sys._getframe(2)
+    while frame is not None:
+        filename = real_path(frame.f_code.co_filename)
+        if filename.startswith(APP_DIR + os.sep) and filename not in PLUMBING_FILES:
+            stack.append(frame_name(frame))
+        elif outside is None and filename not in PLUMBING_FILES:
+            outside = frame_name(frame)
+        frame = frame.f_back
+    return stack or [outside or "unknown"]
+
+
+def call_kind(operation, args):
+    if operation in ('get', 'delete'):
+        return args[0].kind
+    elif operation == 'put':
+        return args[0].key.kind
+    elif operation in ('get_multi', 'delete_multi'):
+        return args[0][0].kind if args[0] else None
+    elif operation == 'put_multi':
+        return args[0][0].key.kind if args[0] else None
+    return args[0]
+
+
+def is_whole_kind(operation, args):
+    # query(kind, filters, projection, keys_only, limit, ...) and scan(kind, filters, ...) with no filter or limit
+    if operation == 'scan':
+        return not args[1]
+    elif operation == 'query':
+        return not args[1] and args[4] is None
+    return False
+
+
+def record_call(operation, args, seconds):
+    """Repository listener: records the call against the current request, if it is being watched"""
+    calls = current_calls.get()
+    if calls is None:
+        return
+
+    stack = call_stack()
+    calls.append(Call(operation, call_kind(operation, args), is_whole_kind(operation, args), stack[0], stack))
+
+
+def find_problems(calls, threshold=None, whole_kind_threshold=None):
+    """Describes every repeated single-key call site and whole-kind fetch above its threshold"""
+    threshold = THRESHOLD if threshold is None else threshold
+    whole_kind_threshold = WHOLE_KIND_THRESHOLD if whole_kind_threshold is None else whole_kind_threshold
+
+    problems = []
+
+    repeated = Counter((call.operation, call.kind, call.site) for call in calls
+                       if call.operation in SINGLE_KEY_OPERATIONS)
+    for (operation, kind, site), count in repeated.items():
+        if count > threshold:
+            stack = next(call.stack for call in calls if (call.operation, call.kind, call.site) == (operation, kind, site))
+            problems.append("{} single-key {} calls on {} from {}; use {}_multi\n    {}".format(
+                count, operation, kind, site, operation, "\n    ".join(stack)))
+
+    whole_kind = [call for call in calls if call.whole_kind]
+    if len(whole_kind) > whole_kind_threshold:
+        for call in whole_kind:
+            problems.append("whole-kind {} of {} from {}; filter, page or count instead\n    {}".format(
+                call.operation, call.kind, call.site, "\n    ".join(call.stack)))
+
+    return problems
+
+
+def report(problems, mode, where):
+    if not problems:
+        return
+
+    message = "Datastore access problems in {}:\n{}".format(where, "\n".join(problems))
+    if mode == 'raise':
+        raise NPlusOneError(message)
+    logger.warning(message)
+
+
+@contextmanager
+def watching(mode='raise', threshold=None, whole_kind_threshold=None):
+    """Records the datastore calls made in the block and reports problems when it ends
+
+    For tests and scripts that call handlers' helpers directly; yields the list of recorded calls.
+    """
+    calls = []
+    token = current_calls.set(calls)
+    try:
+        yield calls
+    finally:
+        current_calls.reset(token)
+
+    report(find_problems(calls, threshold, whole_kind_threshold), mode, "watched block")
+
+
+def allow_whole_kind(view):
+    """Marks a view (e.g. a cron job) that reads whole kinds on purpose"""
+    view.query_guard_whole_kind = True
+    return view
+
+
+def init_app(app, repo, mode=None):
+    """Checks every request of app for N+1 datastore access when mode (or QUERY_GUARD) is set
+
+    Calls are always reported to record_call, so watching() works whatever the mode; outside a
+    watched request or block it returns at once.
+    """
+    repo.listeners.append(record_call)
+
+    mode = MODE if mode is None else mode
+    if not mode:
+        return
+
+    def start_request():
+        g.query_guard_token = current_calls.set([])
+
+    def finish_request(res):
+        if 'query_guard_token' not in g:
+            return res
+
+        calls = current_calls.get()
+        current_calls.reset(g.pop('query_guard_token'))
+
+        view = app.view_functions.get(request.endpoint)
+        whole_kind_threshold = len(calls) if getattr(view, 'query_guard_whole_kind', False) else None
+
+        report(find_problems(calls, whole_kind_threshold=whole_kind_threshold), mode,
+               "{} {}".format(request.method, request.path))
+        return res
+
+    app.before_request(start_request)
+    app.after_request(finish_request)
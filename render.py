@@ -0,0 +1,38 @@
+from flask import make_response
+import json
+import metrics
+
+# orjson is optional; when it is installed responses are encoded with it instead of the stdlib
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Encodes obj as JSON text, with orjson when available"""
+    with metrics.timed("serialize"):
+        if orjson is not None:
+            return orjson.dumps(obj).decode('utf-8')
+        return json.dumps(obj)
+
+
+def entity(entity, self_url=None):
+    """Plain representation of an entity with its id and self link, leaving the entity untouched"""
+    body = dict(entity)
+    body["id"] = entity.key.id
+    if self_url is not None:
+        body["self"] = self_url
+    return body
+
+
+def entities(results, base_url):
+    # Each entity's self link is the collection url followed by its id
+    return [entity(result, base_url + "/" + str(result.key.id)) for result in results]
+
+
+def json_response(obj, status_code=200):
+    res = make_response(dumps(obj))
+    res.headers.set('Content-Type', 'application/json')
+    res.status_code = status_code
+    return res
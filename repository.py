@@ -0,0 +1,566 @@
+from google.cloud import datastore
+from google.api_core.exceptions import Aborted, Conflict, InvalidArgument
+from collections import namedtuple
+from contextlib import contextmanager
+import entity_cache
+import base64
+import bisect
+import copy
+import itertools
+import json
+import operator
+import os
+import random
+import threading
+import time
+
+# Longest key name Datastore accepts
+MAX_KEY_NAME_BYTES = 1500
+
+# One page of query results; next_cursor is None when there is nothing after this page
+Page = namedtuple('Page', ['entities', 'next_cursor'])
+
+# Tries given to a contended transaction, and the bounds (seconds) of the jittered backoff between them
+TRANSACTION_ATTEMPTS = 5
+BACKOFF_BASE = 0.02
+BACKOFF_CAP = 0.5
+
+
+class DatastoreBackend:
+    """Backend that runs every operation against Cloud Datastore through one shared client"""
+
+    def __init__(self, client=None):
+        self._client = client
+        self._lock = threading.Lock()
+
+    @property
+    def client(self):
+        # Created on first use, so importing the app sets up no credentials or channel
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = datastore.Client()
+        return self._client
+
+    def warmup(self):
+        # A lookup of a missing key opens the client's channel before real traffic arrives
+        self.client.get(self.client.key("_warmup", 1))
+
+    def key(self, kind, id_or_name=None):
+        if id_or_name is None:
+            return self.client.key(kind)
+        return self.client.key(kind, id_or_name)
+
+    def allocate_ids(self, kind, count):
+        return self.client.allocate_ids(self.client.key(kind), count)
+
+    def get(self, key):
+        return self.client.get(key)
+
+    def get_multi(self, keys):
+        return self.client.get_multi(keys)
+
+    def put(self, entity):
+        self.client.put(entity)
+
+    def put_multi(self, entities):
+        self.client.put_multi(entities)
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def delete_multi(self, keys):
+        self.client.delete_multi(keys)
+
+    def _build_query(self, kind, filters, projection, keys_only):
+        query = self.client.query(kind=kind)
+        for prop, op, value in filters:
+            query.add_filter(prop, op, value)
+        if projection:
+            query.projection = list(projection)
+        if keys_only:
+            query.keys_only()
+        return query
+
+    def query(self, kind, filters=(), projection=(), keys_only=False, limit=None, offset=0, cursor=None):
+        query = self._build_query(kind, filters, projection, keys_only)
+        iterator = query.fetch(limit=limit, offset=offset or None, start_cursor=cursor)
+        entities = list(next(iterator.pages))
+
+        next_cursor = iterator.next_page_token
+        if isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode('ascii')
+
+        return Page(entities, next_cursor)
+
+    def scan(self, kind, filters=(), projection=(), keys_only=False):
+        # The client pages through the results lazily
+        return self._build_query(kind, filters, projection, keys_only).fetch()
+
+    def count(self, kind, filters=()):
+        return sum(1 for _ in self.scan(kind, filters, keys_only=True))
+
+    def transaction(self):
+        return self.client.transaction()
+
+    def in_transaction(self):
+        return self.client.current_transaction is not None
+
+
+class MemoryTransaction:
+    """Optimistic transaction: buffers writes and aborts on commit if anything it read has changed"""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.reads = {}
+        self.writes = {}
+
+    def __enter__(self):
+        if self.backend.in_transaction():
+            raise ValueError("Nested transactions are not supported")
+        self.backend._local.transaction = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.backend._local.transaction = None
+        if exc_type is None:
+            self.backend._commit(self)
+        return False
+
+
+class MemoryBackend:
+    """Thread-safe in-process stand-in for Datastore, for load tests and profiling without a network
+
+    Entities are stored as copies, so callers mutating what they read does not change stored data.
+    Each kind keeps its keys sorted, and every indexable property value has an equality index kept
+    in the same order, so queries walk one ordered list from their cursor and stop once the page
+    is full. Transactions are optimistic, aborting like Datastore does when another writer got
+    there first.
+    """
+
+    operators = {"=": operator.eq, "<": operator.lt, "<=": operator.le,
+                 ">": operator.gt, ">=": operator.ge}
+
+    def __init__(self, project='memory'):
+        self.project = project
+        self._lock = threading.RLock()
+        self._local = threading.local()
+        self._ids = itertools.count(1)
+
+        # kind -> {key path: entity}
+        self._entities = {}
+
+        # key path -> version, bumped on every committed write
+        self._versions = {}
+
+        # kind -> sorted list of (key order, key path)
+        self._order = {}
+
+        # kind -> {property: {value: sorted list of (key order, key path)}}
+        self._indexes = {}
+
+    def key(self, kind, id_or_name=None):
+        if id_or_name is None:
+            return datastore.Key(kind, project=self.project)
+        return datastore.Key(kind, id_or_name, project=self.project)
+
+    def allocate_ids(self, kind, count):
+        with self._lock:
+            return [self.key(kind, next(self._ids)) for _ in range(count)]
+
+    def warmup(self):
+        pass
+
+    def current_transaction(self):
+        return getattr(self._local, 'transaction', None)
+
+    def in_transaction(self):
+        return self.current_transaction() is not None
+
+    def transaction(self):
+        return MemoryTransaction(self)
+
+    def get(self, key):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys):
+        transaction = self.current_transaction()
+
+        with self._lock:
+            results = []
+            for key in keys:
+                path = key.flat_path
+                if transaction is not None:
+                    transaction.reads.setdefault(path, self._versions.get(path, 0))
+
+                entity = self._entities.get(key.kind, {}).get(path)
+                if entity is not None:
+                    results.append(copy.deepcopy(entity))
+
+            return results
+
+    def put(self, entity):
+        self.put_multi([entity])
+
+    def put_multi(self, entities):
+        for entity in entities:
+            if entity.key.is_partial:
+                entity.key = entity.key.completed_key(next(self._ids))
+
+            # Datastore rejects key names over 1500 bytes
+            if isinstance(entity.key.name, str) and len(entity.key.name.encode('utf-8')) > MAX_KEY_NAME_BYTES:
+                raise InvalidArgument("The key name is longer than {} bytes".format(MAX_KEY_NAME_BYTES))
+
+        writes = [(entity.key.flat_path, entity.key.kind, copy.deepcopy(entity)) for entity in entities]
+        self._write(writes)
+
+    def delete(self, key):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys):
+        self._write([(key.flat_path, key.kind, None) for key in keys])
+
+    def _write(self, writes):
+        transaction = self.current_transaction()
+        if transaction is not None:
+            for path, kind, entity in writes:
+                transaction.writes[path] = (kind, entity)
+            return
+
+        with self._lock:
+            for path, kind, entity in writes:
+                self._apply(path, kind, entity)
+
+    def _commit(self, transaction):
+        with self._lock:
+            for path, version in transaction.reads.items():
+                if self._versions.get(path, 0) != version:
+                    raise Aborted("Transaction aborted: entity {} was modified concurrently".format(path))
+
+            for path, (kind, entity) in transaction.writes.items():
+                self._apply(path, kind, entity)
+
+    def _apply(self, path, kind, entity):
+        # Must be called with the lock held
+        entities = self._entities.setdefault(kind, {})
+        order = self._order.setdefault(kind, [])
+        indexes = self._indexes.setdefault(kind, {})
+        entry = (path_order(path), path)
+
+        old = entities.pop(path, None)
+        if old is not None:
+            remove_sorted(order, entry)
+            for prop, value in set(index_entries(old)):
+                entries = indexes.get(prop, {}).get(value)
+                if entries is not None:
+                    remove_sorted(entries, entry)
+                    if not entries:
+                        del indexes[prop][value]
+
+        if entity is not None:
+            entities[path] = entity
+            bisect.insort(order, entry)
+            for prop, value in set(index_entries(entity)):
+                bisect.insort(indexes.setdefault(prop, {}).setdefault(value, []), entry)
+
+        self._versions[path] = self._versions.get(path, 0) + 1
+
+    def _match(self, kind, filters, after=None, count=None):
+        """Returns the key paths of matching entities in key order
+
+        Only paths after the key order given in after are considered, and at most count are returned.
+        """
+        entities = self._entities.get(kind, {})
+
+        # The shortest equality index is walked; every filter is then checked entity by entity
+        ordered = self._order.get(kind, [])
+        for prop, op, value in filters:
+            if op == "=" and is_hashable(value):
+                entries = self._indexes.get(kind, {}).get(prop, {}).get(value, [])
+                if len(entries) < len(ordered):
+                    ordered = entries
+
+        start = 0
+        if after is not None:
+            start = bisect.bisect_left(ordered, (after,))
+            while start < len(ordered) and ordered[start][0] <= after:
+                start += 1
+
+        matched = []
+        for index in range(start, len(ordered)):
+            if count is not None and len(matched) >= count:
+                break
+            path = ordered[index][1]
+            if all(self._check(entities[path], prop, op, value) for prop, op, value in filters):
+                matched.append(path)
+        return matched
+
+    def _check(self, entity, prop, op, value):
+        compare = self.operators[op]
+
+        # Key filters compare in Datastore's key order
+        if prop == "__key__":
+            return compare(path_order(entity.key.flat_path), path_order(value.flat_path))
+
+        for candidate in property_values(entity, prop):
+            try:
+                if compare(candidate, value):
+                    return True
+            except TypeError:
+                continue
+        return False
+
+    def _result(self, kind, path, projection, keys_only):
+        entity = self._entities[kind][path]
+        if keys_only:
+            return datastore.Entity(key=entity.key)
+        if projection:
+            projected = datastore.Entity(key=entity.key)
+            projected.update({prop: copy.deepcopy(entity[prop]) for prop in projection if prop in entity})
+            return projected
+        return copy.deepcopy(entity)
+
+    def query(self, kind, filters=(), projection=(), keys_only=False, limit=None, offset=0, cursor=None):
+        # The cursor is the path of the last entity returned, so the next page starts right after it
+        after = None
+        if cursor:
+            after = path_order(decode_cursor(kind, cursor))
+
+        with self._lock:
+            # One match past the page shows whether there is a next one
+            end = None if limit is None else offset + limit
+            matched = self._match(kind, filters, after, None if end is None else end + 1)
+            page = matched[offset:end]
+            entities = [self._result(kind, path, projection, keys_only) for path in page]
+
+        next_cursor = None
+        if page and end is not None and end < len(matched):
+            next_cursor = base64.urlsafe_b64encode(json.dumps(page[-1]).encode('utf-8')).decode('ascii')
+
+        return Page(entities, next_cursor)
+
+    def scan(self, kind, filters=(), projection=(), keys_only=False):
+        return iter(self.query(kind, filters, projection, keys_only).entities)
+
+    def count(self, kind, filters=()):
+        with self._lock:
+            if not filters:
+                return len(self._order.get(kind, []))
+            return len(self._match(kind, filters))
+
+
+def decode_cursor(kind, cursor):
+    """Returns the key path a memory cursor points at; fails like Datastore does on a bad one"""
+    try:
+        path = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise InvalidArgument("Invalid query cursor")
+
+    if not isinstance(path, list) or len(path) % 2 or not path or path[0] != kind \
+            or not all(isinstance(part, str) for part in path[0::2]) \
+            or not all(isinstance(part, (int, str)) and not isinstance(part, bool) for part in path[1::2]):
+        raise InvalidArgument("Invalid query cursor")
+
+    return tuple(path)
+
+
+def remove_sorted(entries, entry):
+    # Removes entry from a sorted list, if present
+    index = bisect.bisect_left(entries, entry)
+    if index < len(entries) and entries[index] == entry:
+        del entries[index]
+
+
+def is_hashable(value):
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def property_values(entity, prop):
+    """Yields every value of a dotted property name, expanding lists and embedded entities"""
+    values = [entity]
+    for part in prop.split("."):
+        expanded = []
+        for value in values:
+            if isinstance(value, dict) and part in value:
+                found = value[part]
+                expanded.extend(found if isinstance(found, list) else [found])
+        values = expanded
+    return values
+
+
+def index_entries(entity, prefix=""):
+    """Yields (property, value) pairs for every hashable value, as Datastore indexes them"""
+    for prop, value in entity.items():
+        name = prefix + prop
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, dict):
+                yield from index_entries(item, name + ".")
+            elif is_hashable(item):
+                yield name, item
+
+
+def path_order(path):
+    # Datastore orders numeric ids before names
+    return tuple((0, part, 0) if i % 2 == 0 else ((1, part, 0) if isinstance(part, int) else (2, 0, part))
+                 for i, part in enumerate(path))
+
+
+def create_backend(name=None):
+    """Builds the backend named by name or the DATASTORE_BACKEND environment variable"""
+    name = name or os.environ.get('DATASTORE_BACKEND', 'datastore')
+    if name == 'memory':
+        return MemoryBackend()
+    if name == 'datastore':
+        return DatastoreBackend()
+    raise ValueError("Unknown datastore backend: {}".format(name))
+
+
+class Repository:
+    """Datastore operations used by the blueprints, run against a swappable backend
+
+    get_cached is a read-through cache for hot single-entity reads. Every write made through the
+    repository replaces the written keys in that cache with short-lived tombstones, and again once
+    its transaction commits. A reader only fills a key that holds nothing, so an entity it read
+    before a write cannot be cached after the write's invalidation, unless the read outlasted
+    the tombstone; the entity TTL bounds that case.
+    Calls that reach the backend are reported to the registered listeners.
+    """
+
+    def __init__(self, backend, cache=None):
+        self.backend = backend
+        self.cache = cache
+        self._local = threading.local()
+        # Callables notified of every datastore call as listener(operation, args, seconds)
+        self.listeners = []
+        # Callables notified of every run_in_transaction as listener(name, attempts, committed)
+        self.transaction_listeners = []
+
+    def warmup(self):
+        """Creates the backend's client and connection ahead of the first request"""
+        self.backend.warmup()
+
+    def key(self, kind, id_or_name=None):
+        return self.backend.key(kind, id_or_name)
+
+    def _call(self, operation, method, *args):
+        if not self.listeners:
+            return method(*args)
+
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            seconds = time.perf_counter() - start
+            for listener in self.listeners:
+                listener(operation, args, seconds)
+
+    def allocate_ids(self, kind, count):
+        return self._call('allocate_ids', self.backend.allocate_ids, kind, count)
+
+    def get(self, key):
+        return self._call('get', self.backend.get, key)
+
+    def get_cached(self, key):
+        # Transactions must see (and track) the stored entity, so they bypass the cache
+        if self.cache is None or self.in_transaction():
+            return self.get(key)
+
+        cached_key = entity_cache.cache_key(key)
+        entity = self.cache.get(cached_key)
+
+        if entity is None:
+            entity = self.get(key)
+            if entity is not None:
+                self.cache.add(cached_key, entity)
+
+        return entity
+
+    def get_multi(self, keys):
+        return self._call('get_multi', self.backend.get_multi, keys)
+
+    def put(self, entity):
+        self._call('put', self.backend.put, entity)
+        self._invalidate([entity.key])
+
+    def put_multi(self, entities):
+        self._call('put_multi', self.backend.put_multi, entities)
+        self._invalidate([entity.key for entity in entities])
+
+    def delete(self, key):
+        self._call('delete', self.backend.delete, key)
+        self._invalidate([key])
+
+    def delete_multi(self, keys):
+        self._call('delete_multi', self.backend.delete_multi, keys)
+        self._invalidate(keys)
+
+    def _invalidate(self, keys):
+        if self.cache is None or not keys:
+            return
+
+        self.cache.delete_many([entity_cache.cache_key(key) for key in keys])
+
+        # A reader filling the key after the tombstone expires but before the commit would cache the
+        # old entity, so the keys are invalidated again after it
+        pending = getattr(self._local, 'pending', None)
+        if pending is not None:
+            pending.extend(keys)
+
+    def query(self, kind, filters=(), projection=(), keys_only=False, limit=None, offset=0, cursor=None):
+        """Returns one Page of results; filters are (property, operator, value) tuples"""
+        return self._call('query', self.backend.query, kind, filters, projection, keys_only, limit, offset, cursor)
+
+    def scan(self, kind, filters=(), projection=(), keys_only=False):
+        """Iterates over every matching entity"""
+        # Reported once when the scan starts; the batches it fetches while iterating are not timed
+        return self._call('scan', self.backend.scan, kind, filters, projection, keys_only)
+
+    def count(self, kind, filters=()):
+        return self._call('count', self.backend.count, kind, filters)
+
+    @contextmanager
+    def transaction(self):
+        with self.backend.transaction():
+            self._local.pending = []
+            try:
+                yield
+            finally:
+                pending = self._local.pending
+                self._local.pending = None
+
+        self._invalidate(pending)
+
+    def in_transaction(self):
+        return self.backend.in_transaction()
+
+    def run_in_transaction(self, work, *args):
+        """Runs work(*args) in a transaction and returns its result, retrying when contention aborts it
+
+        Retries wait a random time up to an exponentially growing cap (full jitter), so writers
+        contending for the same entities spread out. The last Conflict is raised once
+        TRANSACTION_ATTEMPTS run out; any other exception from work ends it without a retry.
+        """
+        for attempt in range(1, TRANSACTION_ATTEMPTS + 1):
+            try:
+                with self.transaction():
+                    result = work(*args)
+            except Conflict:
+                if attempt == TRANSACTION_ATTEMPTS:
+                    self._transaction_done(work.__name__, attempt, False)
+                    raise
+                time.sleep(random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** (attempt - 1))))
+            else:
+                self._transaction_done(work.__name__, attempt, True)
+                return result
+
+    def _transaction_done(self, name, attempts, committed):
+        for listener in self.transaction_listeners:
+            listener(name, attempts, committed)
+
+
+repo = Repository(create_backend(), entity_cache.create_cache())
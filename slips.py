@@ -1,14 +1,125 @@
 from google.cloud import datastore
 from flask import Flask, request, Blueprint
-import json
+from google.api_core.exceptions import Conflict
+from repository import repo
 import constants
-
-client = datastore.Client()
+import query_guard
+import render
 
 bp = Blueprint('slips', __name__, url_prefix='/slips')
 
+# Kind with one entity per docked boat (key id = boat id), pointing at the slip it is in
+SLIP_OCCUPANCY_KIND = "slip_occupancy"
+
+
+def release_occupancy(slip):
+    # Removes the occupancy entry of the boat in this slip, if any
+    if slip["current_boat"] is not None:
+        repo.delete(repo.key(SLIP_OCCUPANCY_KIND, int(slip["current_boat"])))
+
+
+def backfill_occupancy(boat_id):
+    """Writes the occupancy entry of a boat docked before entries existed; returns it, or None if not docked"""
+    docked = repo.query(constants.slips, filters=[("current_boat", "=", boat_id)], keys_only=True, limit=1).entities
+    if not docked:
+        return None
+
+    occupancy = datastore.entity.Entity(key=repo.key(SLIP_OCCUPANCY_KIND, boat_id))
+    occupancy.update({"slip_id": docked[0].key.id})
+    repo.put(occupancy)
+    return occupancy
+
+
+class SlipError(Exception):
+    """Raised inside a slip transaction to abort it with an error response"""
+
+    def __init__(self, status_code, message):
+        super().__init__(message)
+        self.status_code = status_code
+        self.message = message
+
+
+# Answer when a slip transaction kept aborting on contention
+CONFLICT = {"Error": "The slip or boat was modified by another request"}
+
+
+def renumber_slip(slip_key, number):
+    """Sets the slip's number and empties it; returns the slip"""
+    slip = repo.get(slip_key)
+
+    # Checks slip with slip_id to see if it exists
+    if not slip:
+        raise SlipError(404, "No boat with this boat_id exists")
+
+    # Patching a slip empties it, so its boat is no longer docked
+    release_occupancy(slip)
+    slip.update({"number": number, "current_boat": None})
+    repo.put(slip)
+    return slip
+
+
+def remove_slip(slip_key):
+    slip = repo.get(slip_key)
+
+    # Checks if slip with slip_id exists
+    if not slip:
+        raise SlipError(404, "No slip with this slip_id exists")
+
+    release_occupancy(slip)
+    repo.delete(slip_key)
+
+
+def dock_boat(slip_key, boat_key):
+    """Puts the boat in the empty slip, with its occupancy entry, in the current transaction
+
+    Returns None once docked, or the error message if the boat is already in another slip.
+    """
+    occupancy_key = repo.key(SLIP_OCCUPANCY_KIND, boat_key.id)
+
+    # Gets slip and boat
+    slip = repo.get(slip_key)
+    boat = repo.get(boat_key)
 
+    # Check contents of the json file to make sure slip and boat exists
+    if not slip or not boat:
+        raise SlipError(404, "The specified boat and/or slip does not exist")
+
+    if slip["current_boat"] is not None:
+        raise SlipError(403, "The slip is not empty")
+
+    # Find if boat_id is already parked in a slip. A backfilled entry must still be committed,
+    # so this case returns its message instead of raising
+    occupancy = repo.get(occupancy_key)
+    if occupancy is None:
+        occupancy = backfill_occupancy(boat.key.id)
+    if occupancy:
+        return f"The boat is already in slip: {occupancy['slip_id']}"
+
+    occupancy = datastore.entity.Entity(key=occupancy_key)
+    occupancy.update({"slip_id": slip.key.id})
+    slip.update({"current_boat": boat.key.id})
+    repo.put_multi([slip, occupancy])
+    return None
+
+
+def undock_boat(slip_key, boat_key):
+    # Gets slip and boat
+    slip = repo.get(slip_key)
+    boat = repo.get(boat_key)
+
+    # Check contents of the json file to make sure slip, boat exists,
+    # and boat is parked at this slip
+    if not slip or not boat or slip["current_boat"] != boat_key.id or slip["current_boat"] is None:
+        raise SlipError(404, "No boat with this boat_id is at the slip with this slip_id")
+
+    release_occupancy(slip)
+    slip.update({"current_boat": None})
+    repo.put(slip)
+
+
+# Slips are the marina's fixed berths and the list is returned unpaged, so reading the whole kind is intended
 @bp.route('', methods=['POST', 'GET'])
+@query_guard.allow_whole_kind
 def slips_get_post():
     if request.method == 'POST':
         content = request.get_json()
@@ -18,22 +129,16 @@ def slips_get_post():
             return {"Error": "The request object is missing the required number"}, 400
 
         # Creates new slip with number value and current_boat attribute set to None (empty)
-        new_slip = datastore.entity.Entity(key=client.key(constants.slips))
+        new_slip = datastore.entity.Entity(key=repo.key(constants.slips))
         new_slip.update({"number": content["number"], "current_boat": None})
-        client.put(new_slip)
-        new_slip["id"] = new_slip.key.id
-
-        return json.dumps(new_slip), 201
+        repo.put(new_slip)
+        return render.dumps(render.entity(new_slip)), 201
 
     elif request.method == 'GET':
-        query = client.query(kind=constants.slips)
-        results = list(query.fetch())
+        results = list(repo.scan(constants.slips))
 
         # Adds id key and value to each json slip
-        for slip in results:
-            slip["id"] = slip.key.id
-
-        return json.dumps(results), 200
+        return render.dumps([render.entity(slip) for slip in results]), 200
 
     else:
         return 'Method not recognized'
@@ -48,41 +153,40 @@ def slips_get_patch_delete(slip_id):
         if not content or "number" not in content:
             return {"Error": "The request object is missing at least one of the required attributes"}, 400
 
-        slip_key = client.key(constants.slips, int(slip_id))
-        slip = client.get(key=slip_key)
+        slip_key = repo.key(constants.slips, int(slip_id))
 
-        # Checks slip with slip_id to see if it exists
-        if not slip:
-            return {"Error": "No boat with this boat_id exists"}, 404
+        # Retried on contention, re-reading the slip each time
+        try:
+            slip = repo.run_in_transaction(renumber_slip, slip_key, content["number"])
+        except SlipError as error:
+            return {"Error": error.message}, error.status_code
+        except Conflict:
+            return CONFLICT, 409
 
-        slip.update({"number": content["number"], "current_boat": None})
-        client.put(slip)
-        slip["id"] = slip.key.id
-
-        return json.dumps(slip), 200
+        return render.dumps(render.entity(slip)), 200
 
     elif request.method == 'DELETE':
-        slip_key = client.key(constants.slips, int(slip_id))
-        slip = client.get(key=slip_key)
-
-        # Checks if slip with slip_id exists
-        if not slip:
-            return {"Error":  "No slip with this slip_id exists"}, 404
+        slip_key = repo.key(constants.slips, int(slip_id))
 
-        client.delete(slip_key)
+        try:
+            repo.run_in_transaction(remove_slip, slip_key)
+        except SlipError as error:
+            return {"Error": error.message}, error.status_code
+        except Conflict:
+            return CONFLICT, 409
 
         return "", 204
 
     elif request.method == 'GET':
-        slip_key = client.key(constants.slips, int(slip_id))
-        slip = client.get(key=slip_key)
+        slip_key = repo.key(constants.slips, int(slip_id))
+        # Hot entities are served from the read-through cache, which writes invalidate
+        slip = repo.get_cached(slip_key)
 
         # Check if slip exists
         if not slip:
             return {"Error": "No slip with this slip_id exists"}, 404
 
-        slip["id"] = slip.key.id
-        return json.dumps(slip), 200
+        return render.dumps(render.entity(slip)), 200
 
     else:
         return 'Method not recognized'
@@ -93,51 +197,32 @@ def slips_get_patch_delete(slip_id):
 @bp.route('/<slip_id>/<boat_id>', methods=['PUT', 'DELETE'])
 def slips_put_delete(slip_id, boat_id):
     if request.method == 'PUT':
+        slip_key = repo.key(constants.slips, int(slip_id))
+        boat_key = repo.key(constants.boats, int(boat_id))
 
-        # Gets slip
-        slip_key = client.key(constants.slips, int(slip_id))
-        slip = client.get(key=slip_key)
-
-        # Gets boat
-        boat_key = client.key(constants.boats, int(boat_id))
-        boat = client.get(key=boat_key)
-
-        # Check contents of the json file to make sure slip and boat exists
-        if not slip or not boat:
-            return {"Error":  "The specified boat and/or slip does not exist"}, 404
-
-        if slip["current_boat"] is not None:
-            return {"Error":  "The slip is not empty"}, 403
+        # The slip and the occupancy entry are read and written in one transaction, retried on contention
+        try:
+            docked_elsewhere = repo.run_in_transaction(dock_boat, slip_key, boat_key)
+        except SlipError as error:
+            return {"Error": error.message}, error.status_code
+        except Conflict:
+            return CONFLICT, 409
 
-        # Find if boat_id is already parked in a
-        query = client.query(kind=constants.slips)
-        slip_list = list(query.fetch())
+        if docked_elsewhere:
+            return {"Error": docked_elsewhere}, 403
 
-        # Adds id key and value to each json slip
-        for curr_slip in slip_list:
-            if curr_slip["current_boat"] == boat_id:
-                return {"Error": f"The boat is already in slip: {curr_slip.key.id}"}, 403
-
-        slip.update({"current_boat": boat.key.id})
-        client.put(slip)
         return "", 204
 
     elif request.method == 'DELETE':
-        # Gets slip
-        slip_key = client.key(constants.slips, int(slip_id))
-        slip = client.get(key=slip_key)
-
-        # Gets boat
-        boat_key = client.key(constants.boats, int(boat_id))
-        boat = client.get(key=boat_key)
-
-        # Check contents of the json file to make sure slip, boat exists,
-        # and boat is parked at this slip
-        if not slip or not boat or slip["current_boat"] != int(boat_id) or slip["current_boat"] is None:
-            return {"Error":  "No boat with this boat_id is at the slip with this slip_id"}, 404
-
-        slip.update({"current_boat": None})
-        client.put(slip)
+        slip_key = repo.key(constants.slips, int(slip_id))
+        boat_key = repo.key(constants.boats, int(boat_id))
+
+        try:
+            repo.run_in_transaction(undock_boat, slip_key, boat_key)
+        except SlipError as error:
+            return {"Error": error.message}, error.status_code
+        except Conflict:
+            return CONFLICT, 409
 
         return "", 204
 
@@ -1,5 +1,9 @@
 from string import ascii_letters, digits
 import random
+import re
+
+# What state_gen produces; anything else cannot be a stored state
+STATE_PATTERN = re.compile("[" + ascii_letters + digits + "]{30}")
 
 
 def state_gen():
@@ -10,3 +14,8 @@ def state_gen():
     pwd = ''.join(random.choice(char_set) for i in range(length))
 
     return pwd
+
+
+def is_state(value):
+    """True if value has the shape of a state made by state_gen"""
+    return isinstance(value, str) and STATE_PATTERN.fullmatch(value) is not None
@@ -0,0 +1,34 @@
+"""Runs the app on the in-memory datastore backend with the Google token verifier stubbed out.
+
+Needs the deployment's constants.py (kind names, client id) on the path like the app itself:
+
+    PYTHONPATH=/path/to/constants python -m pytest tests
+"""
+import os
+import sys
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# The stand-in datastore must be chosen before the repository is imported
+os.environ.setdefault('DATASTORE_BACKEND', 'memory')
+
+OWNER = "tester"
+HEADERS = {"Authorization": "Bearer test", "Accept": "application/json"}
+
+
+@pytest.fixture
+def app(monkeypatch):
+    import transport
+    monkeypatch.setattr(transport, 'verify_oauth2_token',
+                        lambda token, audience: {"sub": OWNER, "exp": time.time() + 3600})
+
+    from main import app
+    return app
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
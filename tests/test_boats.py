@@ -0,0 +1,22 @@
+import pytest
+
+import validation
+
+from conftest import HEADERS
+
+
+@pytest.mark.parametrize("length, status", [(validation.MAX_NAME_LENGTH, 201), (validation.MAX_NAME_LENGTH + 1, 400)])
+def test_boat_name_fits_a_key_name(client, length, status):
+    # The name is also the key name of its reservation, which Datastore caps at 1500 bytes
+    res = client.post("/boats", json={"name": "n" * length, "type": "test", "length": 1}, headers=HEADERS)
+    assert res.status_code == status
+
+
+def test_renaming_to_an_overlong_name_is_rejected(client):
+    res = client.post("/boats", json={"name": "short", "type": "test", "length": 1}, headers=HEADERS)
+    bid = str(res.get_json()["id"])
+
+    long_name = "n" * (validation.MAX_NAME_LENGTH + 1)
+    assert client.patch("/boats/" + bid, json={"name": long_name}, headers=HEADERS).status_code == 400
+    assert client.put("/boats/" + bid, json={"name": long_name, "type": "test", "length": 1},
+                      headers=HEADERS).status_code == 400
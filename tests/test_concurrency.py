@@ -0,0 +1,45 @@
+"""Runs a small configuration of benchmarks/stress.py, so the transactional guarantees are checked in CI"""
+import collections
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks'))
+
+import stress
+import transport
+
+THREADS = 6
+OPERATIONS = 40
+
+
+@pytest.fixture
+def stress_app(app, monkeypatch):
+    # The stress fixture's boats belong to the stress owner
+    monkeypatch.setattr(transport, 'verify_oauth2_token',
+                        lambda token, audience: {"sub": stress.OWNER, "exp": time.time() + 3600})
+    return app
+
+
+def test_concurrent_cargo_moves_keep_invariants(stress_app):
+    boat_ids, load_ids = stress.seed(3, 20)
+    statuses = collections.defaultdict(collections.Counter)
+
+    workers = [threading.Thread(target=stress.worker, args=(stress_app, boat_ids, load_ids, OPERATIONS, index,
+                                                             statuses))
+               for index in range(THREADS)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+
+    winners = stress.race_one_load(stress_app, boat_ids, THREADS)
+    dropped = stress.race_boat_patch(stress_app, boat_ids, THREADS)
+
+    assert not any(status >= 500 for counts in statuses.values() for status in counts)
+    assert winners == 1
+    assert dropped == []
+    assert stress.check_invariants() == []
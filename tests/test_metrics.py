@@ -0,0 +1,16 @@
+from conftest import HEADERS
+
+
+def test_cache_stats_are_exposed(client):
+    res = client.post("/boats", json={"name": "metered", "type": "test", "length": 1}, headers=HEADERS)
+    bid = str(res.get_json()["id"])
+    client.get("/boats/" + bid, headers=HEADERS)
+    client.get("/boats/" + bid, headers=HEADERS)
+
+    body = client.get("/metrics").data.decode()
+
+    for cache in ("jwt", "entity", "certs", "user_keys"):
+        assert 'cache_hits_total{{cache="{}"}}'.format(cache) in body
+        assert 'cache_misses_total{{cache="{}"}}'.format(cache) in body
+    assert "# TYPE cache_hits_total counter" in body
+    assert "# TYPE cache_entries gauge" in body
@@ -0,0 +1,28 @@
+import base64
+
+import pytest
+
+from conftest import HEADERS
+
+LOAD = {"item": "crate", "volume": 1, "creation_date": "01/01/2022"}
+
+
+def test_next_cursor_link_resumes(client):
+    for _ in range(7):
+        assert client.post("/loads", json=LOAD, headers=HEADERS).status_code == 201
+
+    first = client.get("/loads?limit=3&cursor=", headers=HEADERS).get_json()
+    second = client.get(first["next"], headers=HEADERS)
+    assert second.status_code == 200
+
+    first_ids = {load["id"] for load in first["loads"]}
+    assert not first_ids & {load["id"] for load in second.get_json()["loads"]}
+
+
+@pytest.mark.parametrize("cursor", ["!!!", "abc", base64.urlsafe_b64encode(b"[1]").decode(),
+                                    base64.urlsafe_b64encode(b'{"kind": 1}').decode()])
+@pytest.mark.parametrize("route", ["/loads", "/boats", "/users"])
+def test_malformed_cursor_is_a_bad_request(client, route, cursor):
+    res = client.get(route + "?cursor=" + cursor, headers=HEADERS)
+    assert res.status_code == 400
+    assert res.get_json() == {"Error": "The cursor is not valid"}
@@ -0,0 +1,121 @@
+from datetime import datetime, timezone
+import json
+
+from google.cloud import datastore
+import pytest
+
+from repository import repo
+from state_generator import state_gen
+import constants
+import query_guard
+import transport
+
+from conftest import HEADERS
+
+CARGO = 20
+
+
+class StubResponse:
+
+    def __init__(self, body):
+        self.body = body
+
+    def json(self):
+        return self.body
+
+
+def create_boat(client, name):
+    res = client.post("/boats", json={"name": name, "type": "test", "length": 10}, headers=HEADERS)
+    assert res.status_code == 201
+    return str(res.get_json()["id"])
+
+
+def create_loads(client, count):
+    items = [{"item": "crate", "volume": 1, "creation_date": "01/01/2022"}] * count
+    res = client.post("/loads:batch", json=items, headers=HEADERS)
+    assert res.status_code == 200
+    return [str(result["id"]) for result in res.get_json()["results"]]
+
+
+def loaded_boat(client, name):
+    bid = create_boat(client, name)
+    lids = create_loads(client, CARGO)
+    assert client.put("/boats/{}/loads".format(bid), json=lids, headers=HEADERS).status_code == 204
+    return bid, lids
+
+
+def test_watching_records_without_query_guard_mode(client):
+    # The app is set up by the client fixture, with QUERY_GUARD unset
+    def per_key_loop():
+        for load_id in range(1, 8):
+            repo.get(repo.key(constants.loads, load_id))
+
+    with pytest.raises(query_guard.NPlusOneError):
+        with query_guard.watching():
+            per_key_loop()
+
+    with pytest.raises(query_guard.NPlusOneError):
+        with query_guard.watching():
+            list(repo.scan(constants.loads))
+
+
+def test_boat_rename_with_cargo(client):
+    bid, lids = loaded_boat(client, "guarded rename")
+
+    with query_guard.watching():
+        res = client.patch("/boats/" + bid, json={"name": "guarded renamed"}, headers=HEADERS)
+    assert res.status_code == 200
+
+
+def test_boat_delete_with_cargo(client):
+    bid, lids = loaded_boat(client, "guarded delete")
+
+    with query_guard.watching():
+        assert client.delete("/boats/" + bid, headers=HEADERS).status_code == 204
+
+
+def test_load_and_unload(client):
+    bid = create_boat(client, "guarded cargo")
+    lids = create_loads(client, CARGO)
+
+    # Each request is checked on its own, as the guard checks requests
+    for lid in lids[:3]:
+        with query_guard.watching():
+            assert client.put("/boats/{}/loads/{}".format(bid, lid), headers=HEADERS).status_code == 204
+        with query_guard.watching():
+            assert client.delete("/boats/{}/loads/{}".format(bid, lid), headers=HEADERS).status_code == 204
+
+    with query_guard.watching():
+        assert client.put("/boats/{}/loads".format(bid), json=lids, headers=HEADERS).status_code == 204
+    with query_guard.watching():
+        assert client.delete("/boats/{}/loads".format(bid), json=lids, headers=HEADERS).status_code == 204
+
+
+def test_oauth_callback(client, monkeypatch):
+    monkeypatch.setattr(transport, 'post', lambda url, **kwargs: StubResponse(
+        {"access_token": "stub", "id_token": "stub"}))
+    monkeypatch.setattr(transport, 'get', lambda url, **kwargs: StubResponse(
+        {"names": [{"givenName": "Guard", "familyName": "Test"}]}))
+
+    state = state_gen()
+    entity = datastore.entity.Entity(key=repo.key(constants.states, state))
+    entity.update({"state": state, "created": datetime.now(timezone.utc)})
+    repo.put(entity)
+
+    with query_guard.watching() as calls:
+        assert client.get("/oauth?code=stub&state=" + state).status_code == 200
+    assert calls
+
+
+def test_export_fetches_loads_per_page_not_per_boat(client):
+    for index in range(8):
+        bid = create_boat(client, "guarded export {}".format(index))
+        lids = create_loads(client, 2)
+        assert client.put("/boats/{}/loads".format(bid), json=lids, headers=HEADERS).status_code == 204
+
+    with query_guard.watching() as calls:
+        lines = client.get("/boats/export", headers=HEADERS).data.decode().splitlines()
+
+    assert len([line for line in lines if json.loads(line)["kind"] == constants.loads]) >= 16
+    pages = len([call for call in calls if call.operation == 'query'])
+    assert len([call for call in calls if call.operation == 'get_multi']) <= pages
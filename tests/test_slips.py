@@ -0,0 +1,93 @@
+import json
+import threading
+import time
+
+from repository import repo
+import constants
+import slips
+
+from conftest import HEADERS
+
+RACE_THREADS = 8
+RACE_ROUNDS = 5
+
+
+def create_boat(client, name):
+    res = client.post("/boats", json={"name": name, "type": "test", "length": 10}, headers=HEADERS)
+    assert res.status_code == 201
+    return res.get_json()["id"]
+
+
+def create_slip(client, number):
+    res = client.post("/slips", json={"number": number})
+    assert res.status_code == 201
+    return json.loads(res.data)["id"]
+
+
+def test_boat_docked_in_one_slip_cannot_dock_in_another(client):
+    # The boat id in the URL is a string while current_boat is stored as an int
+    bid = create_boat(client, "docked once")
+    slip_a = create_slip(client, 1)
+    slip_b = create_slip(client, 2)
+
+    assert client.put("/slips/{}/{}".format(slip_a, bid)).status_code == 204
+
+    res = client.put("/slips/{}/{}".format(slip_b, bid))
+    assert res.status_code == 403
+    assert json.loads(res.data) == {"Error": "The boat is already in slip: {}".format(slip_a)}
+
+
+def test_undocked_boat_can_dock_again(client):
+    bid = create_boat(client, "docked twice")
+    slip_a = create_slip(client, 3)
+    slip_b = create_slip(client, 4)
+
+    assert client.put("/slips/{}/{}".format(slip_a, bid)).status_code == 204
+    assert client.delete("/slips/{}/{}".format(slip_a, bid)).status_code == 204
+    assert client.put("/slips/{}/{}".format(slip_b, bid)).status_code == 204
+
+
+def test_boat_docked_before_occupancy_entries_cannot_dock_in_another(client):
+    bid = create_boat(client, "docked before")
+    slip_a = create_slip(client, 5)
+    slip_b = create_slip(client, 6)
+
+    # Docked by the old code: current_boat is set but there is no occupancy entry
+    slip = repo.get(repo.key(constants.slips, slip_a))
+    slip["current_boat"] = bid
+    repo.put(slip)
+
+    assert client.put("/slips/{}/{}".format(slip_b, bid)).status_code == 403
+    assert repo.get(repo.key(slips.SLIP_OCCUPANCY_KIND, bid))["slip_id"] == slip_a
+
+
+def test_racing_docks_of_one_boat_let_exactly_one_win(client, app, monkeypatch):
+    # A pause between the occupancy read and the writes makes the racing transactions overlap
+    backfill_occupancy = slips.backfill_occupancy
+
+    def slow_backfill_occupancy(boat_id):
+        time.sleep(0.005)
+        return backfill_occupancy(boat_id)
+
+    monkeypatch.setattr(slips, 'backfill_occupancy', slow_backfill_occupancy)
+
+    for round_number in range(RACE_ROUNDS):
+        bid = create_boat(client, "docked racing {}".format(round_number))
+        slip_ids = [create_slip(client, number) for number in range(RACE_THREADS)]
+        barrier = threading.Barrier(RACE_THREADS)
+        statuses = []
+
+        def dock(slip_id):
+            racer = app.test_client()
+            barrier.wait()
+            statuses.append(racer.put("/slips/{}/{}".format(slip_id, bid)).status_code)
+
+        racers = [threading.Thread(target=dock, args=(slip_id,)) for slip_id in slip_ids]
+        for thread in racers:
+            thread.start()
+        for thread in racers:
+            thread.join()
+
+        # Losers see the boat docked (403) or, past the retries, the contention (409); never a 500
+        assert statuses.count(204) == 1
+        assert set(statuses) <= {204, 403, 409}
@@ -0,0 +1,86 @@
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import threading
+
+import pytest
+
+import transport
+
+CERTS = {"stub-key": "-----BEGIN CERTIFICATE-----\nstub\n-----END CERTIFICATE-----\n"}
+
+
+class StubGoogle(BaseHTTPRequestHandler):
+    """Serves the certs with a max-age and the token endpoint, over keep-alive connections"""
+
+    protocol_version = "HTTP/1.1"
+    requests_seen = []
+    connections = 0
+
+    def setup(self):
+        # One handler serves every request of a connection
+        StubGoogle.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        self.requests_seen.append(self.path)
+        self.reply(CERTS, {"Cache-Control": "public, max-age=3600"})
+
+    def do_POST(self):
+        self.requests_seen.append(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        self.reply({"access_token": "stub", "id_token": "stub"}, {"Cache-Control": "no-store"})
+
+    def reply(self, body, headers):
+        data = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def stub_url(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubGoogle)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    url = "http://127.0.0.1:{}".format(server.server_address[1])
+    monkeypatch.setattr(transport, 'CERTS_URL', url + "/oauth2/v1/certs")
+
+    # A fresh cert cache and connection pool, so counts start from zero
+    transport.auth_request.cache.clear()
+    transport.auth_request.fetches = 0
+    transport.adapter.poolmanager.clear()
+    StubGoogle.requests_seen = []
+    StubGoogle.connections = 0
+
+    yield url
+
+    server.shutdown()
+    server.server_close()
+
+
+def test_certs_are_fetched_once_per_max_age(stub_url):
+    # The stub token is not a JWT, so each verification fails after the certs are loaded
+    for _ in range(3):
+        with pytest.raises(ValueError):
+            transport.verify_oauth2_token("not-a-jwt", audience="client")
+
+    assert transport.stats()["cert_fetches"] == 1
+    assert transport.stats()["cert_cache_hits"] == 2
+    assert StubGoogle.requests_seen == ["/oauth2/v1/certs"]
+
+
+def test_pooled_connection_is_reused(stub_url):
+    transport.auth_request(transport.CERTS_URL)
+    for _ in range(3):
+        assert transport.post(stub_url + "/token", data={"code": "stub"}).json()["access_token"] == "stub"
+
+    assert len(StubGoogle.requests_seen) == 4
+    assert StubGoogle.connections == 1
@@ -0,0 +1,89 @@
+from google.auth import exceptions
+from google.auth.transport import requests as google_requests
+from google.oauth2 import id_token
+from requests.adapters import HTTPAdapter
+from ttl_cache import TTLCache
+import requests
+import os
+import re
+import time
+
+# Endpoints can be pointed at a local stub server through the environment
+TOKEN_URL = os.environ.get('GOOGLE_TOKEN_URL', 'https://oauth2.googleapis.com/token')
+CERTS_URL = os.environ.get('GOOGLE_CERTS_URL', 'https://www.googleapis.com/oauth2/v1/certs')
+GOOGLE_ISSUERS = ['accounts.google.com', 'https://accounts.google.com']
+
+max_age_re = re.compile(r'max-age=(\d+)')
+
+# One keep-alive session shared by every outgoing call to Google
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+session.mount('https://', adapter)
+session.mount('http://', adapter)
+
+
+def cache_lifetime(headers):
+    """Returns how many seconds a response may be reused for, based on Cache-Control and Age"""
+    cache_control = headers.get('Cache-Control', '')
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+
+    match = max_age_re.search(cache_control)
+    if not match:
+        return 0
+
+    return int(match.group(1)) - int(headers.get('Age', '0') or 0)
+
+
+class CachingRequest(google_requests.Request):
+    """google-auth transport on the shared session that reuses GET responses for their max-age"""
+
+    def __init__(self, http_session):
+        super().__init__(session=http_session)
+        self.cache = TTLCache(capacity=16)
+        self.fetches = 0
+
+    def __call__(self, url, method='GET', **kwargs):
+        if method != 'GET':
+            return super().__call__(url, method=method, **kwargs)
+
+        response = self.cache.get(url)
+        if response is not None:
+            return response
+
+        response = super().__call__(url, method=method, **kwargs)
+        self.fetches += 1
+
+        lifetime = cache_lifetime(response.headers)
+        if response.status == 200 and lifetime > 0:
+            self.cache.set(url, response, expires_at=time.time() + lifetime)
+
+        return response
+
+
+auth_request = CachingRequest(session)
+
+
+def verify_oauth2_token(token, audience):
+    # Same checks as google.oauth2.id_token.verify_oauth2_token, but against the cached certs
+    id_info = id_token.verify_token(token, auth_request, audience=audience, certs_url=CERTS_URL)
+
+    if id_info['iss'] not in GOOGLE_ISSUERS:
+        raise exceptions.GoogleAuthError(
+            "Wrong issuer. 'iss' should be one of the following: {}".format(GOOGLE_ISSUERS))
+
+    return id_info
+
+
+def post(url, **kwargs):
+    return session.post(url, **kwargs)
+
+
+def get(url, **kwargs):
+    return session.get(url, **kwargs)
+
+
+def stats():
+    cert_stats = auth_request.cache.stats()
+    return {"cert_fetches": auth_request.fetches, "cert_cache_hits": cert_stats["hits"],
+            "cert_cache_misses": cert_stats["misses"]}
@@ -0,0 +1,74 @@
+from collections import OrderedDict
+import threading
+import time
+
+
+class TTLCache:
+    """Bounded LRU cache where each entry may also carry its own expiry time"""
+
+    def __init__(self, capacity=1024, clock=time.time):
+        self.capacity = capacity
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+
+            # Entries past their expiry are dropped on read
+            if entry is None or (entry[1] is not None and entry[1] <= self.clock()):
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return default
+
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, expires_at=None):
+        """Stores value under key; expires_at is an absolute epoch time or None"""
+        if expires_at is not None and expires_at <= self.clock():
+            return
+
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def _store(self, key, value, expires_at):
+        self._entries[key] = (value, expires_at)
+        self._entries.move_to_end(key)
+
+        # Evict least recently used entries once over capacity
+        while len(self._entries) > self.capacity:
+            self._entries.popitem(last=False)
+
+    def add(self, key, value, expires_at=None):
+        """Stores value only if key has no live entry, atomically; returns whether it was stored"""
+        if expires_at is not None and expires_at <= self.clock():
+            return False
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[1] is None or entry[1] > self.clock()):
+                return False
+            self._store(key, value, expires_at)
+            return True
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses,
+                    "size": len(self._entries), "capacity": self.capacity}
+
+    def __len__(self):
+        return len(self._entries)
@@ -1,12 +1,71 @@
 from flask import Blueprint, request, make_response, jsonify
 from google.cloud import datastore
-import json
+from ttl_cache import TTLCache
+from repository import repo
 import constants
-
-client = datastore.Client()
+import counters
+import pagination
+import etags
+import render
 
 bp = Blueprint('users', __name__, url_prefix='/users')
 
+# Properties listed by GET /users; the projection query over them is declared in index.yaml
+PUBLIC_FIELDS = ("first", "last", "sub")
+
+# Process-local map of sub -> user key for users known to exist
+user_keys = TTLCache(capacity=4096)
+
+
+def find_user_key(sub):
+    """Returns the key of the user with this sub, or None if they have not signed up"""
+    user_key = user_keys.get(sub)
+    if user_key is not None:
+        return user_key
+
+    # Users are keyed by their sub
+    user_key = repo.key(constants.users, sub)
+    if repo.get(user_key) is None:
+        # Users created before keying by sub have generated ids, so fall back to an indexed lookup
+        results = repo.query(constants.users, filters=[("sub", "=", sub)], keys_only=True, limit=1).entities
+        if not results:
+            return None
+        user_key = results[0].key
+
+    user_keys.set(sub, user_key)
+    return user_key
+
+
+def insert_user(new_user):
+    """Writes the new user and adds it to the users counter in the current transaction
+
+    Another login of the same user may have created it since it was looked up, in which case
+    nothing is written and False is returned.
+    """
+    if repo.get(new_user.key) is not None:
+        return False
+
+    repo.put(new_user)
+    counters.increment(counters.USERS)
+    return True
+
+
+def get_or_create_user(first, last, sub):
+    # A returning login costs at most one keyed get and one keys-only query, and none once cached
+    user_key = find_user_key(sub)
+    if user_key is not None:
+        return user_key
+
+    new_user = datastore.entity.Entity(key=repo.key(constants.users, sub))
+    new_user.update({"first": first, "last": last, "sub": sub})
+
+    # The user and its counter are written together, retried on contention; the read inside the
+    # transaction keeps concurrent first logins from counting the same user twice
+    repo.run_in_transaction(insert_user, new_user)
+
+    user_keys.set(sub, new_user.key)
+    return new_user.key
+
 
 @bp.route('', methods=['GET'])
 def user_get_public():
@@ -20,15 +79,29 @@ def user_get_public():
         return res
 
     if request.method == "GET":
-        query = client.query(kind=constants.users)
-        results = list(query.fetch())
-        user_list = {"self": request.root_url + "users", "users": results}
+        # The user count comes from its sharded counter instead of enumerating keys
+        total_users = counters.total(counters.USERS)
 
-        # Sends json response
-        res = make_response(json.dumps(user_list))
-        res.headers.set('Content-Type', 'application/json')
-        res.status_code = 200
-        return res
+        # Get one page of users, by cursor or by limit and offset, reading only the public fields
+        try:
+            results, next_url = pagination.fetch_page(constants.users, [], request.args, request.base_url,
+                                                      projection=PUBLIC_FIELDS)
+        except pagination.InvalidCursor:
+            res = make_response(pagination.INVALID_CURSOR)
+            res.headers.set('Content-Type', 'application/json')
+            res.status_code = 400
+            return res
+
+        user_list = {"self": request.root_url + "users", "users": [dict(result) for result in results]}
+
+        # There is a next_url
+        if next_url:
+            user_list["next"] = next_url
+
+        user_list["total_users"] = total_users
+
+        # Sends json response, or 304 if the client already has this page
+        return etags.conditional(render.json_response(user_list))
 
     else:
         # Status code 405
@@ -0,0 +1,89 @@
+from datetime import datetime
+from functools import lru_cache
+from string import ascii_letters, digits, whitespace
+import re
+
+MISSING = "The request object is missing at least one of the required attributes"
+INVALID = "The request object has at least one invalid value assigned to an attribute"
+
+# Characters allowed in names, types and items, compiled once instead of a set difference per check
+TEXT_PATTERN = re.compile("[" + re.escape(ascii_letters + digits + whitespace) + "]*")
+
+DATE_FORMAT = "%m/%d/%Y"
+
+# Boat names are also Datastore key names (the name reservation), which are limited to 1500 bytes;
+# text values are ASCII, so characters and bytes agree
+MAX_NAME_LENGTH = 1500
+
+
+@lru_cache(maxsize=4096)
+def is_date(value):
+    # Source: https://www.programiz.com/python-programming/datetime/strftime
+    # Dates repeat heavily across loads, so each distinct string is parsed once
+    try:
+        datetime.strptime(value, DATE_FORMAT)
+    except ValueError:
+        return False
+    return True
+
+
+def text(allow_empty=True, max_length=None):
+    """Letters, digits and whitespace only, at most max_length characters if given"""
+    def check(value):
+        return isinstance(value, str) and (allow_empty or value != "") \
+            and (max_length is None or len(value) <= max_length) and TEXT_PATTERN.fullmatch(value) is not None
+    return check
+
+
+def integer():
+    def check(value):
+        return isinstance(value, int)
+    return check
+
+
+def date():
+    """A real calendar date written as mm/dd/yyyy"""
+    def check(value):
+        return isinstance(value, str) and len(value) == 10 and is_date(value)
+    return check
+
+
+class Schema:
+    """Required attributes of a request body, each with the check its value must pass"""
+
+    def __init__(self, **fields):
+        self.fields = tuple(fields.items())
+
+    def validate(self, content, partial=False):
+        """Returns {attribute: "missing" or "invalid"} for every problem found; empty when valid
+
+        With partial (PATCH bodies) only the attributes present with a non-empty value are checked.
+        Attributes outside the schema are ignored.
+        """
+        if not isinstance(content, dict) or (not content and not partial):
+            return {name: "missing" for name, check in self.fields}
+
+        errors = {}
+        for name, check in self.fields:
+            if name not in content:
+                if not partial:
+                    errors[name] = "missing"
+            elif partial and not content[name]:
+                continue
+            elif not check(content[name]):
+                errors[name] = "invalid"
+        return errors
+
+    def updates(self, content):
+        # The schema's attributes that a PATCH body sets, i.e. present with a non-empty value
+        return {name: content[name] for name, check in self.fields if name in content and content[name]}
+
+
+def error_body(errors):
+    # Keeps the existing messages, with every failing attribute listed beside them
+    message = MISSING if "missing" in errors.values() else INVALID
+    return {"Error": message, "attributes": errors}
+
+
+BOAT = Schema(name=text(allow_empty=False, max_length=MAX_NAME_LENGTH), type=text(), length=integer())
+LOAD = Schema(item=text(), volume=integer(), creation_date=date())